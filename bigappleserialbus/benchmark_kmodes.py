@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+__author__ = 'Jeremy B. Merrill'
+__email__ = 'jeremybmerrill@gmail.com'
+__license__ = 'Apache'
+__version__ = '0.1'
+
+# The k-modes clusterers in kmodes.py vs. another version of kmodes.py, e.g. the one from before
+# their loops were vectorized:
+#
+#   git show <commit>:bigappleserialbus/kmodes.py > /tmp/kmodes_before.py
+#   python benchmark_kmodes.py /tmp/kmodes_before.py [points ...]
+#
+# Each clusters the same points, from the same seed, once; it prints how long each took and the
+# cost each came to, which should match, except for "KModes batch": that's this KModes moving
+# points in batches, against the other's moving them one at a time (see the batch argument to
+# KModes._perform_clustering). The points are trajectories in buses.db (read from a copy of it, so
+# the real one isn't migrated), jittered to make as many as asked for, with their segment times
+# binned into categories.
+
+import os
+import sys
+import imp
+import time
+import shutil
+import random
+import logging
+import tempfile
+import yaml
+import numpy as np
+
+import kmodes
+import trajectorystore
+from trajectory import Base, migrate
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+point_counts = [500, 2000]
+k = 4
+jitter = 10 # seconds
+bin_seconds = 30
+# (clusterer, its arguments, arguments to this kmodes.py's _perform_clustering only; the other one's runs without them)
+clusterers = [("KModes", {}, {}), ("KModes", {}, {'batch': True}), ("FuzzyKModes", {'alpha': 1.5}, {}), ("FuzzyCentroidsKModes", {'alpha': 1.8}, {})]
+
+def categorical_trajectories(session, count):
+  """count jittered trajectories from the biggest configured store, as segment-time bins (points x segments)."""
+  stores = [trajectorystore.TrajectoryStore(route_name, stop_id).load(session) for route_name, stop_id in configured_stops()]
+  store = max(stores, key=lambda store: store.count)
+  prefix_length = int(np.median(store.lengths)) / 2 # halfway along the route
+  real = store.segments[store.lengths >= prefix_length, :prefix_length].astype(float)
+  random_state = np.random.RandomState(0)
+  points = real[random_state.randint(len(real), size=count)] + random_state.normal(0, jitter, (count, prefix_length))
+  return (np.maximum(points, 0) / bin_seconds).astype(int)
+
+def time_clustering(module, name, args, x, seed=0, clustering_args={}):
+  """Cluster x with module's name clusterer; returns (seconds, cost)."""
+  random.seed(seed)
+  np.random.seed(seed)
+  clusterer = getattr(module, name)(k, **args)
+  start = time.time()
+  clusterer._perform_clustering(x, verbose=0, **clustering_args)
+  return (time.time() - start, clusterer.cost)
+
+def configured_stops():
+  config = yaml.load(open(os.path.join(os.path.dirname(__file__), "../config.yaml"), 'r'))
+  return [(info["route_name"], info["stop"]) for info in config["stops"]]
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.WARNING)
+  if len(sys.argv) < 2:
+    sys.exit("usage: python benchmark_kmodes.py other_kmodes.py [points ...]")
+  other = imp.load_source('other_kmodes', sys.argv[1])
+  counts = map(int, sys.argv[2:]) or point_counts
+  sqlite_db_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "../buses.db")
+  scratch_db = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+  scratch_db.close()
+  shutil.copy(sqlite_db_path, scratch_db.name)
+  engine = create_engine('sqlite:///' + scratch_db.name)
+  Base.metadata.create_all(engine)
+  session = sessionmaker(bind=engine)()
+  try:
+    migrate(engine, session)
+    points = [(count, categorical_trajectories(session, count)) for count in counts]
+  finally:
+    session.close()
+    os.remove(scratch_db.name)
+
+  print("%8s %22s %10s %10s %8s %14s %14s" % ("points", "clusterer", "other s", "this s", "speedup", "other cost", "this cost"))
+  for count, x in points:
+    for name, args, clustering_args in clusterers:
+      other_seconds, other_cost = time_clustering(other, name, args, x)
+      seconds, cost = time_clustering(kmodes, name, args, x, clustering_args=clustering_args)
+      print("%8i %22s %10.2f %10.2f %8.1f %14.4f %14.4f" % (count, ' '.join([name] + sorted(clustering_args)), other_seconds, seconds, other_seconds / seconds, other_cost, cost))
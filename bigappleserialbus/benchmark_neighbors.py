@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+__author__ = 'Jeremy B. Merrill'
+__email__ = 'jeremybmerrill@gmail.com'
+__license__ = 'Apache'
+__version__ = '0.1'
+
+# Exact (ball tree) vs approximate (lshindex.py) nearest-neighbor search:
+#
+#   python benchmark_neighbors.py [tables ...]
+#
+# 1. latency and recall, on bigger and bigger histories made by jittering the trajectories in buses.db
+# 2. arrival-time error, replaying the capture log (see replay.py) with each
+#
+# Each works on its own copy of buses.db, so the real one isn't migrated or replayed into, and
+# trajectories one replay saves don't carry over to the next.
+
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+import yaml
+import numpy as np
+from sklearn.neighbors import NearestNeighbors
+
+import bus
+import trajectorystore
+from lshindex import RandomProjectionIndex
+from busstop import BusStop
+from replay import Replay
+from trajectory import Base, migrate
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+history_sizes = [1000, 10000, 50000]
+query_count = 200
+k = 10
+jitter = 10 # seconds
+
+def latency(session, tables_options):
+  """Print, for each history size, how long each search takes per query (fit amortized away) and how many of the exact neighbors it finds."""
+  stores = [trajectorystore.TrajectoryStore(route_name, stop_id).load(session) for route_name, stop_id in configured_stops()]
+  store = max(stores, key=lambda store: store.count)
+  prefix_length = int(np.median(store.lengths)) / 2 # halfway along the route
+  real = bus.preprocess_trajectory(store.segments[store.lengths >= prefix_length, :prefix_length].astype(float))
+  random = np.random.RandomState(0)
+  print("%(route)s/%(stop)s, %(count)i real trajectories, prefix of %(prefix)i segments" %
+    {'route': store.route_name, 'stop': store.end_stop_id, 'count': len(real), 'prefix': prefix_length})
+  print("%8s %12s %10s %10s %8s" % ("history", "search", "fit ms", "query ms", "recall"))
+  for size in history_sizes:
+    history = real[random.randint(len(real), size=size)] + random.normal(0, jitter, (size, real.shape[1]))
+    queries = real[random.randint(len(real), size=query_count)] + random.normal(0, jitter, (query_count, real.shape[1]))
+    exact_indices = None
+    for name, index in [("exact", NearestNeighbors(n_neighbors=k, algorithm='ball_tree'))] + \
+                       [("lsh x%i" % tables, RandomProjectionIndex(n_neighbors=k, tables=tables)) for tables in tables_options]:
+      start = time.time()
+      index.fit(history)
+      fit_seconds = time.time() - start
+      start = time.time()
+      indices = np.array([index.kneighbors(query.reshape(1, -1))[1][0] for query in queries]) # one bus at a time, like a tick
+      query_seconds = (time.time() - start) / query_count
+      if exact_indices is None:
+        exact_indices = indices
+      recall = np.mean([len(set(found) & set(exact)) / float(k) for found, exact in zip(indices, exact_indices)])
+      print("%8i %12s %10.1f %10.3f %8.2f" % (size, name, fit_seconds * 1000, query_seconds * 1000, recall))
+
+def arrival_errors(db_path, approximate_above, tables):
+  """Replay the capture log, searching approximately past approximate_above trajectories; returns (rmse per stop, seconds)."""
+  bus.approximate_neighbors_above = approximate_above
+  bus.approximate_tables = tables
+  trajectorystore.stores.clear()
+  trajectorystore.fitted_indexes = trajectorystore.FittedIndexCache()
+  session, scratch_db_path = scratch_session(db_path)
+  stdout = sys.stdout
+  sys.stdout = open(os.devnull, 'w') # BusStop and Bus print a lot
+  try:
+    stops = []
+    for route_name, stop_id, distance in configured_stops(with_distance=True):
+      stop = BusStop(route_name, stop_id)
+      stop.add_attributes(distance, session)
+      stops.append(stop)
+    start = time.time()
+    report = Replay(stops, session).run()
+    seconds = time.time() - start
+  finally:
+    sys.stdout.close()
+    sys.stdout = stdout
+    session.close()
+    os.remove(scratch_db_path)
+  return (report, seconds)
+
+def scratch_session(db_path):
+  """A session on a copy of the db at db_path, and the copy's path, to remove when done."""
+  scratch_db = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+  scratch_db.close()
+  shutil.copy(db_path, scratch_db.name)
+  engine = create_engine('sqlite:///' + scratch_db.name)
+  Base.metadata.create_all(engine)
+  session = sessionmaker(bind=engine)()
+  migrate(engine, session)
+  return (session, scratch_db.name)
+
+def configured_stops(with_distance=False):
+  config = yaml.load(open(os.path.join(os.path.dirname(__file__), "../config.yaml"), 'r'))
+  if with_distance:
+    return [(info["route_name"], info["stop"], int(info["distance"])) for info in config["stops"]]
+  return [(info["route_name"], info["stop"]) for info in config["stops"]]
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.WARNING)
+  tables_options = map(int, sys.argv[1:]) or [2, 8, 16]
+  sqlite_db_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "../buses.db")
+  session, scratch_db_path = scratch_session(sqlite_db_path)
+  try:
+    latency(session, tables_options)
+  finally:
+    session.close()
+    os.remove(scratch_db_path)
+
+  print("")
+  print("%12s %10s  %s" % ("search", "replay s", "rmse by stop"))
+  for name, approximate_above, tables in [("exact", None, None)] + [("lsh x%i" % tables, 0, tables) for tables in tables_options]:
+    report, seconds = arrival_errors(sqlite_db_path, approximate_above, tables)
+    print("%12s %10.1f  %s" % (name, seconds, ', '.join(["%s/%s %.0fs" % (route_name, stop_id, rmse) for route_name, stop_id, _, rmse in report if rmse is not None])))
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+__author__ = 'Jeremy B. Merrill'
+__email__ = 'jeremybmerrill@gmail.com'
+__license__ = 'Apache'
+__version__ = '0.1'
+
+# The ways of finding similar trajectories (see bus.similarity_method), head to head:
+#
+#   python benchmark_similarity.py [method ...]
+#
+# replays the capture log (see replay.py) with each, on its own copy of buses.db (so models one
+# saves don't carry over to the next), and prints how long the replay and its predictions took and
+# the arrival-time error at each stop.
+
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+import yaml
+
+import bus
+import busstop
+import trajectorystore
+import trajectoryclusters
+import trajectoryprototypes
+from busstop import BusStop
+from replay import Replay
+from trajectory import Base, migrate
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+methods = ['knn', 'kmeans', 'kprototypes']
+
+def arrival_errors(db_path, method):
+  """Replay the capture log with bus.similarity_method set to method; returns (rmse per stop, replay seconds, prediction seconds)."""
+  bus.similarity_method = method
+  trajectorystore.stores.clear()
+  trajectorystore.fitted_indexes = trajectorystore.FittedIndexCache()
+  trajectoryclusters.loaded.clear()
+  trajectoryprototypes.loaded.clear()
+  scratch_db = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+  scratch_db.close()
+  shutil.copy(db_path, scratch_db.name)
+  engine = create_engine('sqlite:///' + scratch_db.name)
+  Base.metadata.create_all(engine)
+  session = sessionmaker(bind=engine)()
+  migrate(engine, session)
+
+  predicting = [0.0]
+  find_similar_trajectories_for = busstop.find_similar_trajectories_for
+  def timed(buses):
+    start = time.time()
+    try:
+      return find_similar_trajectories_for(buses)
+    finally:
+      predicting[0] += time.time() - start
+  busstop.find_similar_trajectories_for = timed
+  stdout = sys.stdout
+  sys.stdout = open(os.devnull, 'w') # BusStop and Bus print a lot
+  try:
+    stops = []
+    for route_name, stop_id, distance in configured_stops():
+      stop = BusStop(route_name, stop_id)
+      stop.add_attributes(distance, session)
+      stops.append(stop)
+    start = time.time()
+    report = Replay(stops, session).run()
+    seconds = time.time() - start
+  finally:
+    sys.stdout.close()
+    sys.stdout = stdout
+    busstop.find_similar_trajectories_for = find_similar_trajectories_for
+    session.close()
+    os.remove(scratch_db.name)
+  return (report, seconds, predicting[0])
+
+def configured_stops():
+  config = yaml.load(open(os.path.join(os.path.dirname(__file__), "../config.yaml"), 'r'))
+  return [(info["route_name"], info["stop"], int(info["distance"])) for info in config["stops"]]
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.WARNING)
+  sqlite_db_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "../buses.db")
+  print("%12s %10s %12s  %s" % ("method", "replay s", "predict s", "rmse by stop"))
+  for method in sys.argv[1:] or methods:
+    report, seconds, predicting = arrival_errors(sqlite_db_path, method)
+    print("%12s %10.1f %12.2f  %s" % (method, seconds, predicting, ', '.join(["%s/%s %.0fs" % (route_name, stop_id, rmse) for route_name, stop_id, _, rmse in report if rmse is not None])))
@@ -17,8 +17,15 @@ else:
   logging.basicConfig(level=logging.DEBUG) #stdout
 
 from operator import itemgetter
+from collections import OrderedDict
 import time
+from multiprocessing.pool import ThreadPool
+from Queue import Queue, Empty
 from busstop import BusStop, read_bustime_data_from_disk
+from routefetcher import RouteFetcher
+from retryqueue import RetryQueue
+from replay import Replay
+import trajectorystore
 import yaml
 import os
 from ticker import Ticker
@@ -30,7 +37,8 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
-from busstop import Base, TestCompleteException
+from busstop import Base
+from trajectory import migrate
 
 print("debug?", read_bustime_data_from_disk)
 
@@ -38,16 +46,15 @@ class BigAppleSerialBus:
   is_on_pi = False
   lights = {}
 
-  #The MTA's bustime website pings every 15 seconds, so I feel comfortable doing the same.
-  between_checks = 15 if not read_bustime_data_from_disk else 0 #seconds
-  between_status_updates = 3 if not read_bustime_data_from_disk else 0  #seconds
+  #The MTA's bustime website pings every 15 seconds, so I feel comfortable doing the same, or a little more when a bus is about to flip a light.
+  #check_buses runs every tick and polls only the routes whose stops are due (see BusStop.seconds_until_next_check).
+  between_checks = 1 #seconds
+  between_status_updates = 3 #seconds
 
   def __init__(self):
     self.is_on_pi = is_on_pi()
     self.__init_db__()
     self.bus_stops = []
-    if read_bustime_data_from_disk:
-      self.session_errors = [] #only for testing :)
 
     if self.is_on_pi:
       import RPi.GPIO as GPIO
@@ -55,6 +62,12 @@ class BigAppleSerialBus:
       logging.debug("am running on a Raspberry Pi")
 
     self.__init_stops__()
+    if read_bustime_data_from_disk:
+      # replays don't poll, so they don't need the ticker, the fetchers or the fetch pool.
+      self.replay()
+      return
+    self.__init_route_fetchers__()
+    self.__init_fetch_pool__()
     self.__cycle_lights__()
     self.__init_ticker__()
 
@@ -70,6 +83,8 @@ class BigAppleSerialBus:
         stop = BusStop(busName, stop_id) #TODO: needs kwargs?
         self.session.add(stop)
       stop.add_attributes(int(info["distance"]), self.session)
+      # predictions come from here, not the db
+      trajectorystore.store_for(busName, stop_id, self.session, info.get("history_count"), info.get("history_days"))
 
       self.bus_stops.append(stop)
       if self.is_on_pi:
@@ -79,30 +94,78 @@ class BigAppleSerialBus:
         self.lights[stop]['red'] = Light(info["redPin"])
         self.lights[stop]['green'] = Light(info["greenPin"])
 
+  def __init_route_fetchers__(self):
+    # stops on the same route see the same buses, so they share one BusTime request.
+    stops_by_route = OrderedDict()
+    for stop in self.bus_stops:
+      stops_by_route.setdefault(stop.route_name, []).append(stop)
+    self.route_fetchers = [RouteFetcher(route_name, stops) for route_name, stops in stops_by_route.items()]
+
+  def __init_fetch_pool__(self):
+    # one worker per route, so a tick costs about one BusTime round trip instead of one per route.
+    self.fetch_pool = ThreadPool(max(len(self.route_fetchers), 1))
+    self.retry_queue = RetryQueue()
+    self.finished_retries = Queue()
+
+  def replay(self):
+    """Run the captured BusTime responses back through the stops (see replay.py).
+
+       The trajectories it sees aren't saved, as they weren't when stops read debugjson, so it's repeatable.
+    """
+    return Replay(self.bus_stops, self.session, save_trajectories=False).run(on_check=self.convert_to_lights)
+
   def check_buses(self):
-    if not self.bus_stops:
-      print(self.session_errors)
-      print("buses: " + ','.join(map(lambda a: a[0] + ": " + str(len(a[1])), self.session_errors)))
-      print("sums: "  + ','.join(map(lambda a: str(sqrt(sum( map(lambda x: x**2, a[1])) )), self.session_errors)))
-      print("rmses: " + ','.join(map(lambda a: str(sqrt(sum( map(lambda x: x**2, a[1])) )/len(a[1])), self.session_errors)))
+    # routes whose last fetch failed are left to retry_failed_fetches, so they don't hold up the others.
+    now = time.time()
+    route_fetchers = [route_fetcher for route_fetcher in self.route_fetchers 
+                        if route_fetcher.next_check_at() <= now and not self.retry_queue.is_waiting(route_fetcher)]
+    if not route_fetchers:
+      return
+    # only the network requests run in parallel; parsing, prediction and the db stay on this thread.
+    for route_fetcher, stop_locations in self.fetch_pool.map(fetch_route, route_fetchers):
+      self.check_stops(route_fetcher, stop_locations)
+    self.session.commit()
 
-      raise TestCompleteException("Test complete!")
-    for stop in self.bus_stops:
+  def retry_failed_fetches(self):
+    """Runs every tick: start retries whose backoff is up, and check the stops for any retries that have come back.
+
+       The retries themselves run on the fetch pool, so a slow or dead route never blocks the ticker.
+    """
+    for route_fetcher in self.retry_queue.due(time.time()):
+      self.fetch_pool.apply_async(fetch_route, (route_fetcher,), callback=self.finished_retries.put)
+    checked_any = False
+    while True:
+      try:
+        route_fetcher, stop_locations = self.finished_retries.get_nowait()
+      except Empty:
+        break
+      self.check_stops(route_fetcher, stop_locations)
+      checked_any = True
+    if checked_any:
+      self.session.commit()
+
+  def check_stops(self, route_fetcher, stop_locations):
+    """Update the stops on one route from its fetched locations; failed fetches go on the retry queue."""
+    for stop, locations in stop_locations:
       logging.debug("checking %(route_name)s/%(end_stop_id)s (%(count)i buses on route)" % 
         {'route_name': stop.route_name, 'count': len(stop.buses_on_route), 'end_stop_id': stop.stop_id })
-      try:
-        trajectories = stop.check()
-      except TestCompleteException: #for testing only
-        self.session_errors.append((stop.route_name, stop.session_errors))
-        self.bus_stops.remove(stop)
-        continue
+      trajectories = stop.check(locations)
       for traj in [traj for traj in trajectories if traj]:
         logging.debug("writing trajectory:" + str(traj))
-        if not read_bustime_data_from_disk: 
-          self.session.add(traj)
+        self.session.add(traj)
+        trajectorystore.store_for(traj.route_name, traj.end_stop_id, self.session).append(traj)
 
       self.convert_to_lights(stop)
-    self.session.commit()
+
+    if any([stop.status_error for stop in route_fetcher.stops]):
+      self.retry_queue.failed(route_fetcher, time.time())
+    else:
+      self.retry_queue.succeeded(route_fetcher)
+      now = time.time()
+      for stop in route_fetcher.stops:
+        stop.schedule_next_check(now)
+      logging.debug("next check of %(route_name)s in %(sec)is" % 
+        {'route_name': route_fetcher.route_name, 'sec': route_fetcher.next_check_at() - now})
 
   def broadcast_status(self):
     if self.is_on_pi:
@@ -113,7 +176,7 @@ class BigAppleSerialBus:
     if not self.is_on_pi:
       return
     if bus_stop.status_error:
-      [light.toggle() for light in self.lights[bus_stop]]
+      [light.toggle() for light in self.lights[bus_stop].values()]
     else:
       if bus_stop.bus_is_near:
         self.lights[bus_stop]['green'].on()
@@ -137,22 +200,24 @@ class BigAppleSerialBus:
     Base.metadata.create_all(engine)
     Base.metadata.bind = engine
      
-    DBSession = sessionmaker(bind=engine)
+    # fetch_pool threads read BusStop attributes, so they mustn't be expired (and lazily re-queried from another thread) by commit().
+    DBSession = sessionmaker(bind=engine, expire_on_commit=False)
     self.session = DBSession()
+    migrate(engine, self.session)
 
   def __cycle_lights__(self):
     flat_lights = [item for sublist in [d.values() for d in self.lights.values()] for item in sublist]
     for light in flat_lights:
       light.on()
-      if not read_bustime_data_from_disk:
-        time.sleep(2)
+      time.sleep(2)
       light.off()
 
   def __init_ticker__(self):
-    ticker = Ticker(None if not read_bustime_data_from_disk else 0)
+    ticker = Ticker()
     ticker.register(self.check_buses, self.between_checks)
     #TODO: only print new status on non-15-sec ticks if it hasn't changed
     ticker.register(self.broadcast_status, self.between_status_updates)
+    ticker.register(self.retry_failed_fetches, 1)
     ticker.global_error(self.__global_error__)
     ticker.start()
 
@@ -172,16 +237,27 @@ class BigAppleSerialBus:
       while True:
         for red_light in [light_pair['red'] for light_pair in light_pairs]:
           red_light.on()
-        if not read_bustime_data_from_disk:
-          time.sleep(5)
+        time.sleep(5)
         for red_light in [light_pair['red'] for light_pair in light_pairs]:
           red_light.off()
-        if not read_bustime_data_from_disk:
-          time.sleep(5)
+        time.sleep(5)
     else:
       print(error)
       raise error
 
+def fetch_route(route_fetcher):
+  """Runs on a fetch_pool worker thread; returns the fetcher along with its locations so results can be matched up.
+
+     Anything that goes wrong counts as a failed fetch, so check_stops puts the route back on the
+     retry queue. (A retry's exception would otherwise vanish into the pool, leaving the route
+     waiting on a retry that never comes back.)
+  """
+  try:
+    return (route_fetcher, route_fetcher.get_locations())
+  except Exception:
+    logging.exception("fetching %(route_name)s failed" % {'route_name': route_fetcher.route_name})
+    return (route_fetcher, [(stop, (None, None, False)) for stop in route_fetcher.stops])
+
 if __name__ == "__main__":
   BigAppleSerialBus()
 
@@ -7,9 +7,10 @@ __version__ = '0.1'
 
 from datetime import datetime, timedelta
 # import time
-from trajectory import Trajectory
+from trajectory import Trajectory, time_bucket
+import trajectorystore
 from itertools import tee, izip
-from collections import OrderedDict
+from collections import OrderedDict, deque
 
 from sqlalchemy import Column, ForeignKey, Integer, String, Text
 from sqlalchemy.ext.declarative import declarative_base
@@ -18,31 +19,42 @@ from sqlalchemy import orm
 # from pylab import plot,show
 from numpy import vstack,array
 from numpy.random import rand
-from scipy.cluster.vq import kmeans,vq
 import kmodes
 from sklearn.neighbors import NearestNeighbors
+from lshindex import RandomProjectionIndex
+import trajectoryclusters
+import trajectoryprototypes
+from busposition import BusPosition, PositionHistory
 
 import logging #magically the same as the one in bigappleserialbus.py
 
 default_bus_speed = 4 # m/s ~= 8 miles per hour
+speed_history_length = 10 # time/location pairs kept per bus for get_speed_mps, newest first
 #sometimes the bus, at the terminal where it starts, reports itself as, e.g. 0.2 meters along the route.
 #this is used to decide that, yes, it's still at the start of the route.
 max_gps_error = 20 #meters
 
-# any segment longer than this disqualifies the trajectory, since something went wonky here
-MAX_SEGMENT_TIME = 300 
-MIN_SEGMENT_TIME = 20
+# Past this many trajectories in a time bucket, search them approximately (see lshindex.py) rather than
+# exactly; None to always search exactly. approximate_tables trades speed for recall. See
+# benchmark_neighbors.py for how much either costs.
+approximate_neighbors_above = None
+approximate_tables = 8
+
+# How to find similar trajectories: 'knn', the k nearest neighbors, 'kmeans', the rest of the bus's
+# cluster (see trajectoryclusters.py), or 'kprototypes', the rest of the bus's cluster by its segments
+# and when it started, from every time bucket (see trajectoryprototypes.py).
+similarity_method = 'knn'
 
 class Bus:
-  def __init__(self, number, journey, route_name, end_stop_id, session):
+  def __init__(self, number, visit, route_name, end_stop_id, session):
     self.number = number
-    self.time_location_pairs = []
+    self.time_location_pairs = deque(maxlen=speed_history_length)
 
     self.stop_time_pairs = OrderedDict() #store time along the route
     self.start_time = None
     self.stops = []
     self.stop_distances = {}
-    self.previous_bus_positions = []
+    self.previous_bus_positions = PositionHistory()
     self.db_session = session
     self.route_name = route_name
     self.end_stop_id = end_stop_id
@@ -50,10 +62,14 @@ class Bus:
     self.green_light_time = None
     self.seconds_away = None
     self.error = None
+    self.last_recorded_at_str = None
+    self.similar_trajectories = None # the last find_similar_trajectories() result
+    self.prediction_key = None # what the memoized prediction was made from; see prediction_key_for
+    self.memoized_prediction = None
 
     self.first_projected_arrival = datetime.min
     self.first_projected_arrival_speeds = 0
-    self.set_trajectory_points(journey)
+    self.set_trajectory_points(visit)
 
   def __repr__(self):
     seconds_away_str = ''
@@ -70,26 +86,26 @@ class Bus:
           'sec': seconds_away_str
         }
 
-  def add_observed_position(self, journey, recorded_at_str):
-    """tk"""
-    bus_position = {
-      'recorded_at': datetime.strptime(recorded_at_str[:19], "%Y-%m-%dT%H:%M:%S"), #recorded_at
-      'next_stop': journey["OnwardCalls"]["OnwardCall"][0]["StopPointRef"], #next_stop_ref
-      'next_stop_name': journey["OnwardCalls"]["OnwardCall"][0]["StopPointName"],
-      'distance_along_route': journey["MonitoredCall"]["Extensions"]["Distances"]["CallDistanceAlongRoute"] - journey["MonitoredCall"]["Extensions"]["Distances"]["DistanceFromCall"],
-      'distance_to_end': journey["MonitoredCall"]["Extensions"]["Distances"]["DistanceFromCall"], #distance_from_call
-      'distance_to_next_stop': journey["OnwardCalls"]["OnwardCall"][0]["Extensions"]["Distances"]["DistanceFromCall"],
-      'is_at_stop': journey["OnwardCalls"]["OnwardCall"][0]["Extensions"]["Distances"]["PresentableDistance"] == "at stop",
-    }
+  def add_observed_position(self, visit):
+    """From a siri.Visit, add the bus's current position."""
+    self.last_recorded_at_str = visit.recorded_at
+    next_call = visit.onward_calls[0]
+    bus_position = BusPosition(
+      datetime.strptime(visit.recorded_at[:19], "%Y-%m-%dT%H:%M:%S"), #recorded_at
+      next_call.stop_ref, #next_stop_ref
+      visit.monitored_call.distance_along_route - visit.monitored_call.distance_from_call, #distance_along_route
+      visit.monitored_call.distance_from_call, #distance_to_end
+      next_call.presentable_distance == "at stop", #is_at_stop
+    )
     self._add_observed_position(bus_position)
 
   def _add_observed_position(self, bus_position):
-    """From a bus_position, object, update the bus's internal representation of its location and previous trajectory."""
-    bus_position['is_underway'] = bus_position['next_stop'] in self.stops and self.stops.index(bus_position['next_stop']) >= 0
+    """From a BusPosition, update the bus's internal representation of its location and previous trajectory."""
+    bus_position.is_underway = bus_position.next_stop in self.stops and self.stops.index(bus_position.next_stop) >= 0
     #legacy crap, for speed stuff
-    if not (self.time_location_pairs and self.time_location_pairs[0][0] == bus_position['recorded_at']):
-      self.time_location_pairs.insert(0, [bus_position['recorded_at'], bus_position['distance_to_end']])
-    if not bus_position['is_underway']:
+    if not (self.time_location_pairs and self.time_location_pairs[0][0] == bus_position.recorded_at):
+      self.time_location_pairs.appendleft([bus_position.recorded_at, bus_position.distance_to_end])
+    if not bus_position.is_underway:
       return;
 
     if not self.previous_bus_positions:
@@ -100,26 +116,26 @@ class Bus:
     self.previous_bus_positions.append(bus_position)
 
     # if this bus_position hasn't been updated since the last check, skip it.
-    if previous_bus_position['recorded_at'] == bus_position['recorded_at']:
+    if previous_bus_position.recorded_at == bus_position.recorded_at:
       return
     # if the bus hasn't moved (i.e. the current next stop has already been visited)
-    if self.stop_time_pairs and self.stop_time_pairs[bus_position['next_stop']]:
+    if self.stop_time_pairs and self.stop_time_pairs[bus_position.next_stop]:
       return
     # as soon as the bus starts moving away from its start point. 
     # (Don't count as its start_time time it spends going the opposite direction)
-    if not self.start_time and bus_position['is_underway']:
-      self.start_time = bus_position['recorded_at']
+    if not self.start_time and bus_position.is_underway:
+      self.start_time = bus_position.recorded_at
 
     #if we've passed the next stop (i.e. the first key with None as its value), interpolate its value
 
     #TODO: test this real good.
-    for missed_stop in self.stops[:self.stops.index(bus_position['next_stop'])]:
+    for missed_stop in self.stops[:self.stops.index(bus_position.next_stop)]:
       if self.stop_time_pairs[missed_stop] is None:
-        distance_traveled = previous_bus_position['distance_to_end'] - bus_position['distance_to_end']
-        time_elapsed = bus_position['recorded_at'] - previous_bus_position['recorded_at']
+        distance_traveled = previous_bus_position.distance_to_end - bus_position.distance_to_end
+        time_elapsed = bus_position.recorded_at - previous_bus_position.recorded_at
         assert time_elapsed.seconds > 0
         print("%(bus_name)s add_observed_position interpolated; next stop: %(stop_ref)s, so prev_stop: %(missed)s @ %(missed_dist)s away" % 
-          {'bus_name': self.number, 'stop_ref': bus_position['next_stop'], 'missed': missed_stop, 'missed_dist': self.stop_distances[self.stops[-1]] - self.stop_distances[missed_stop]})
+          {'bus_name': self.number, 'stop_ref': bus_position.next_stop, 'missed': missed_stop, 'missed_dist': self.stop_distances[self.stops[-1]] - self.stop_distances[missed_stop]})
         # print("distance: prev: %(prev_loc)fm, this: %(this_loc)fm; prev_dist: %(prev_dist)f; curtime: %(currec)s, prev: %(prevrec)s" % 
         #   {'prev_loc': previous_bus_position['distance_to_end'], 'this_loc': bus_position['distance_to_end'], 
         #   'prev_dist': previous_bus_position['distance_to_next_stop'], 'prevrec':previous_bus_position['recorded_at'], 'currec': bus_position['recorded_at']})
@@ -132,10 +148,10 @@ class Bus:
         # assume a constant speed
         # 100 sec here is time_elapsed.seconds
         # 600m is distance_traveled
-        # 150m is (for first stop) self.stop_distances[missed_stop] - previous_bus_position['distance_along_route']
-        distance_to_missed_stop = int(self.stop_distances[missed_stop] - previous_bus_position['distance_along_route'])
+        # 150m is (for first stop) self.stop_distances[missed_stop] - previous_bus_position.distance_along_route
+        distance_to_missed_stop = int(self.stop_distances[missed_stop] - previous_bus_position.distance_along_route)
         if distance_to_missed_stop < 0:
-          print(self.number, missed_stop, bus_position['next_stop'], self.stop_distances[missed_stop], previous_bus_position['distance_along_route'])
+          print(self.number, missed_stop, bus_position.next_stop, self.stop_distances[missed_stop], previous_bus_position.distance_along_route)
         assert(distance_to_missed_stop >= 0)
 
         time_to_missed_stop = int(time_elapsed.seconds * (float(distance_to_missed_stop) / distance_traveled) )
@@ -143,26 +159,26 @@ class Bus:
           logging.debug("time_to_missed_stop < 0: " + str(time_to_missed_stop) + " (" + str(time_elapsed.seconds) + " * " + str(distance_to_missed_stop) + " / " + str(distance_traveled) + ")")
         assert(time_to_missed_stop >= 0)
         print("prev/curr dist: %(prev_dist)f/%(curr_dist)f, time elapsed: %(time_elapsed)i, time to stop: %(time_to)i" %
-          {'prev_dist': previous_bus_position['distance_to_end'], 'curr_dist': bus_position['distance_to_end'], 
+          {'prev_dist': previous_bus_position.distance_to_end, 'curr_dist': bus_position.distance_to_end, 
            'time_elapsed': time_elapsed.seconds, 'time_to': time_to_missed_stop})
 
-        interpolated_prev_stop_arrival_time = timedelta(seconds=time_to_missed_stop) + previous_bus_position['recorded_at']
+        interpolated_prev_stop_arrival_time = timedelta(seconds=time_to_missed_stop) + previous_bus_position.recorded_at
         self.stop_time_pairs[missed_stop] = interpolated_prev_stop_arrival_time
     
     #if we're at a stop, add it to the stop_time_pairs 
     # (being at_stop and needing to interpolate the previous stop are not mutually exclusive.)
-    if self.stops.index(bus_position['next_stop']) > 0 and bus_position['is_at_stop']:
-      self.stop_time_pairs[bus_position['next_stop']] = bus_position['recorded_at']
+    if self.stops.index(bus_position.next_stop) > 0 and bus_position.is_at_stop:
+      self.stop_time_pairs[bus_position.next_stop] = bus_position.recorded_at
       # print("%(bus_name)s add_observed_position at stop" % {'bus_name': self.number})
 
     # Buses often lay over at the first stop, so we record the *last* time it as at the stop.
     first_stop = self.stops[0]
-    if self.stops.index(bus_position['next_stop']) == 1 and self.stop_time_pairs[first_stop] is None:
-      self.stop_time_pairs[first_stop] = previous_bus_position['recorded_at']
+    if self.stops.index(bus_position.next_stop) == 1 and self.stop_time_pairs[first_stop] is None:
+      self.stop_time_pairs[first_stop] = previous_bus_position.recorded_at
       # print("%(bus_name)s add_observed_position at stop 1" % {'bus_name': self.number})
 
     print(self.number + str(self.stop_time_pairs))
-    print(self.number + " stop_time_pairs at " + str(bus_position['next_stop']) + " set to " + str(self.stop_time_pairs[bus_position['next_stop']]))
+    print(self.number + " stop_time_pairs at " + str(bus_position.next_stop) + " set to " + str(self.stop_time_pairs[bus_position.next_stop]))
     # print the progress so far.
     # print(self.number + ": ")
     # print([(stop_ref, self.stop_time_pairs[stop_ref].strftime("%H:%M:%S")) if self.stop_time_pairs[stop_ref] else (stop_ref,) for stop_ref in self.stops ])
@@ -176,7 +192,7 @@ class Bus:
        won't be called, and then the final member of stop_time_pairs won't get set. Then we won't be able to 
        save the bus as a trajectory. This method fixes the last element in this circumstance.
 
-       We don't have a "journey" in that case. 
+       We don't have a "visit" in that case. 
     """
     # if a bus stops appearing the API responses, but never got any values filled in
     # (e.g. because it ran a route in the other direction than what we're following, then left service)
@@ -186,14 +202,13 @@ class Bus:
       return
 
     print(self.number + " filling in last stop")
-    bus_position = {
-      'recorded_at': datetime.strptime(recorded_at_str[:19], "%Y-%m-%dT%H:%M:%S"), #recorded_at
-      'next_stop': self.stops[-1],
-      'distance_to_end': 0.0,
-      'distance_along_route': self.stop_distances[self.stops[-1]],
-      'distance_to_next_stop': 0.0,
-      'is_at_stop': True,
-    }
+    bus_position = BusPosition(
+      datetime.strptime(recorded_at_str[:19], "%Y-%m-%dT%H:%M:%S"), #recorded_at
+      self.stops[-1], #next_stop
+      self.stop_distances[self.stops[-1]], #distance_along_route
+      0.0, #distance_to_end
+      True, #is_at_stop
+    )
     self._add_observed_position(bus_position)
 
     # # if the only None in stop_time_pairs is at the end (for the last stop)
@@ -205,8 +220,8 @@ class Bus:
 
   # this just fills in the keys to self.stop_time_pairs and members of self.stops
   # called only on init.
-  def set_trajectory_points(self, journey):
-    starting_distance_along_route = journey["OnwardCalls"]["OnwardCall"][0]["Extensions"]["Distances"]["CallDistanceAlongRoute"]
+  def set_trajectory_points(self, visit):
+    starting_distance_along_route = visit.onward_calls[0].distance_along_route
     if starting_distance_along_route < max_gps_error:
       # print("%(bus_name)s at start: (%(dist)f m away)" % {'bus_name': self.number, 'dist': starting_distance_along_route} )
       self.has_full_data = True
@@ -214,9 +229,9 @@ class Bus:
       print("%(bus_name)s added mid-route: (%(dist)f m along route)" % {'bus_name': self.number, 'dist': starting_distance_along_route} )
       self.has_full_data = False
 
-    for index, onward_call in enumerate(journey["OnwardCalls"]["OnwardCall"]):
-      stop_ref = onward_call["StopPointRef"]
-      distance_along_route = onward_call["Extensions"]["Distances"]["CallDistanceAlongRoute"]
+    for index, onward_call in enumerate(visit.onward_calls):
+      stop_ref = onward_call.stop_ref
+      distance_along_route = onward_call.distance_along_route
       if stop_ref not in self.stops:
         # i = stop_ref #IntermediateStop(self.route_name, stop_ref, onward_call["StopPointName"])
         self.stops.append(stop_ref)
@@ -225,7 +240,7 @@ class Bus:
         assert index == 0 or distance_along_route >= self.stop_distances[self.stops[index-1]] #distances should increase, ensuring the stops are in order
       if index == 0:
         self.stop_time_pairs[stop_ref] = self.start_time
-      if stop_ref == journey["MonitoredCall"]["StopPointRef"]:
+      if stop_ref == visit.monitored_call.stop_ref:
         break
 
   # called when we're done with the bus (i.e. it's passed the stop we're interested in)
@@ -264,57 +279,37 @@ class Bus:
     return segment_intervals  
 
   def find_similar_trajectories(self):
-    trajs = self.db_session.query(Trajectory.start_time, Trajectory.segment0,Trajectory.segment1,Trajectory.segment2,Trajectory.segment3,Trajectory.segment4,
-      Trajectory.segment5,Trajectory.segment6,Trajectory.segment7,Trajectory.segment8,Trajectory.segment9,Trajectory.segment10,
-      Trajectory.segment11,Trajectory.segment12,Trajectory.segment13,Trajectory.segment14,Trajectory.segment15,
-      Trajectory.segment16,Trajectory.segment17,Trajectory.segment18,Trajectory.segment19,Trajectory.segment20,
-      Trajectory.segment21,Trajectory.segment22,Trajectory.segment23,Trajectory.segment24,Trajectory.segment25,
-      Trajectory.segment26,Trajectory.segment27,Trajectory.segment28,Trajectory.segment29,Trajectory.segment30,
-      Trajectory.segment31,Trajectory.segment32,Trajectory.segment33,Trajectory.segment34,Trajectory.segment35,
-      Trajectory.segment36,Trajectory.segment37,Trajectory.segment38,Trajectory.segment39).filter(Trajectory.route_name==self.route_name).filter(Trajectory.end_stop_id == self.end_stop_id)
-    
-    trajs = [traj for traj in trajs if not any(map(lambda x: x != None and (x > MAX_SEGMENT_TIME or x < MIN_SEGMENT_TIME), traj[1:])) ]
-    # TODO: before filtering based on similarity by segments, filter by time.
-
-    similar_trajectories_by_time = self.filter_by_time(trajs)
-    similar_trajectories_by_time = [traj[1:] for traj in similar_trajectories_by_time] #remove the time item.
-    if not similar_trajectories_by_time:
-      return {'similar': [], 'seconds_away': -1}
-
-
-    # this "backup" method was in use until 1/15/15  (Next 19 lines)
-    # backoff: if there's tons of trajectories, make a maximum of N clusters (max_clusters)
-    # if N clusters would make "my" cluster contain M trajectories and M < minimum_similar_trajectories
-    #   then try again with N_2 as N_1 / 2
-    # 
-    # How did I compute max_clusters? 
-    # count of time_periods * count of weather variables * weekday_types * 4
-    # time_periods = early-morning-rush, late-morning-rush, late-morning, early-afternoon, mid-afternoon, early-evening-rush, late-evening-rush, late-evening, overnight
-    # weather_variables: hot, cold, rainy, snowy
-    # weekday_types: weekday, weekend
-    # max_clusters = 288
-    # minimum_similar_trajectories = 5
-    # similar_trajectories = self.filter_by_segment_intervals(similar_trajectories_by_time, max_clusters)
-    # clusters_cnt = max_clusters
-    # while clusters_cnt > 1 and len(similar_trajectories) < minimum_similar_trajectories and len(similar_trajectories) > 0:
-    #   # logging.debug(' '.join(map(str, ["backing off, with cluster count", clusters_cnt, "too few similar trajectories", len(similar_trajectories), "from",len(similar_trajectories_by_time), "total"])))
-    #   clusters_cnt = clusters_cnt / 2
-    #   similar_trajectories = self.filter_by_segment_intervals(similar_trajectories_by_time, clusters_cnt)
-
-    similar_trajectories = self.filter_by_segment_intervals(similar_trajectories_by_time, 144)
-
-    if not similar_trajectories:
-      return {'similar': [], 'seconds_away': -1}
+    """Find the trajectories most like this bus's so far, and predict when it'll get to end_stop_id from them.
 
+       (BusStop.check does all its buses at once with find_similar_trajectories_for.)
+    """
+    return find_similar_trajectories_for([self])[0]
 
+  def similarity_query(self, store):
+    """What to look for in the store: (candidates, last_defined_segment_index, query row), or None if we can't predict yet."""
+    # TODO: before filtering based on similarity by segments, filter by time.
+    candidates = self.filter_by_time(store)
+    if not len(candidates):
+      return None
     segment_intervals = self.segment_intervals()
+    if segment_intervals is None or all([seg is None for seg in  segment_intervals]):
+      return None
+    #truncate to last defined point of this bus (i.e. where it is now) to find similar trajectories _so far_.
+    # print('%(bus_name)s segment_intervals: ' % {'bus_name': self.number} + ', '.join(map(str, segment_intervals)))
     last_defined_segment_index = segment_intervals.index(None) if None in segment_intervals else len(segment_intervals)
+    truncated_segment_intervals = preprocess_trajectory(array(segment_intervals[:last_defined_segment_index]))
+    return (candidates, last_defined_segment_index, truncated_segment_intervals)
+
+  def predict_from(self, store, similar_trajectories, last_defined_segment_index, end_segment_index):
+    """Predict seconds_away from similar_trajectories (rows of store), which end end_segment_index segments along the route."""
+    if not len(similar_trajectories):
+      return no_prediction()
     # average time-to-home-stop of the similar trajectories
-    remaining_times_on_similar_trajectories = [sum(traj[last_defined_segment_index:]) for traj in similar_trajectories]
+    remaining_times_on_similar_trajectories = store.remaining_times(similar_trajectories, last_defined_segment_index, end_segment_index)
 
     # two methods of determining the remaining time from the similar trajectories
     # average the remaining times
-    seconds_away = sum(remaining_times_on_similar_trajectories) / len(similar_trajectories)
+    seconds_away = int(remaining_times_on_similar_trajectories.sum()) / len(similar_trajectories)
     # sum the medians for each remaining segment
     # seconds_away =  sum([median(list(x)) for x in zip(*[traj[last_defined_segment_index:] for traj in similar_trajectories])])
 
@@ -328,50 +323,29 @@ class Bus:
     self.seconds_away = seconds_away
     return {'similar': similar_trajectories, 'seconds_away': seconds_away}
 
-  def filter_by_time(self, trajs):
-    if self.start_time is None:
-      return trajs
-    def to_time_of_day(time):
-      if time.hour in [7,8,9]:
-        return 0
-      elif time.hour in [17,18,19]:
-        return 1
-      elif time.hour in [10,11,12,13,14,15,16]:
-        return 2
-      elif time.hour in  [20,21,22,23,0,1,2,3,4,5,6]:
-        return 3
-    is_a_weekend = self.start_time.weekday() in [5,6]
-    by_day = filter(lambda traj: (traj[0].weekday() in [5,6]) == is_a_weekend , trajs)
-    if not is_a_weekend:
-      time_of_day = to_time_of_day(self.start_time)
-      by_time_of_day = filter(lambda traj: to_time_of_day(traj[0]) == time_of_day, by_day)
-    else:
-      by_time_of_day = by_day
-    return by_time_of_day
-
-  def filter_by_segment_intervals(self, trajs, number_of_clusters):
-    truncate_trajs_to = trajs[0].index(None)
-    trajs = [traj[:truncate_trajs_to] for traj in trajs]
-
+  def segment_time_prediction(self, store):
+    """Predict seconds_away with no search: the median times of the bus's remaining segments in its time bucket, added up
+       (see TrajectoryStore.segment_times). p80_seconds_away adds up the 80th percentiles. None if there's not enough history."""
     segment_intervals = self.segment_intervals()
-    if segment_intervals is None or all([seg is None for seg in  segment_intervals]):
-      return []
-    #truncate to last defined point of this bus (i.e. where it is now) to find similar trajectories _so far_.
-    # print('%(bus_name)s segment_intervals: ' % {'bus_name': self.number} + ', '.join(map(str, segment_intervals)))
+    if segment_intervals is None or all([seg is None for seg in segment_intervals]):
+      return None
     last_defined_segment_index = segment_intervals.index(None) if None in segment_intervals else len(segment_intervals)
-    truncated_trajectories_list = [traj[:last_defined_segment_index] for traj in trajs]
-    truncated_trajectories_list = map(preprocess_trajectory, truncated_trajectories_list)
-    truncated_trajectories = array(truncated_trajectories_list)
-    truncated_segment_intervals = preprocess_trajectory(segment_intervals[:last_defined_segment_index])
-    if False: # knearestneighbors is mostly untested
-      similar_trajectory_indexes = find_similar_by_kmeans(truncated_trajectories, truncated_segment_intervals, number_of_clusters)
-    else:
-      similar_trajectory_indexes = find_similar_by_k_nearest_neighbors(truncated_trajectories, truncated_segment_intervals)
-    similar_trajectories = [trajs[i] for i in similar_trajectory_indexes]
-    return similar_trajectories
-
+    bucket = time_bucket(self.start_time) if self.start_time is not None else None
+    estimate = store.segment_times(bucket).between(last_defined_segment_index, len(segment_intervals))
+    if estimate is None:
+      return None
+    self.seconds_away = int(estimate[0])
+    return {'similar': [], 'seconds_away': int(estimate[0]), 'p80_seconds_away': int(estimate[1])}
 
+  def prediction_key_for(self, store):
+    """Everything a prediction depends on: how far the bus has gotten, its time bucket, the trajectories in that bucket
+       and where they are in the store (which an eviction anywhere changes)."""
+    bucket = time_bucket(self.start_time) if self.start_time is not None else None
+    return (tuple(self.segment_intervals() or []), bucket, store.version_of(bucket), store.evictions)
 
+  def filter_by_time(self, store):
+    """Indexes into store of the trajectories from the same kind of day (and, on weekdays, time of day) as this bus."""
+    return store.candidates(self.start_time)
 
   #called when a bus's lights are turned off, when there's not time to make it to the bus
   def too_late(self):
@@ -379,11 +353,11 @@ class Bus:
 
   #called when a bus's lights are turned red, when there's just enough time to make it to the bus
   def imminent(self):
-    self.red_light_time = self.previous_bus_positions[-1]['recorded_at']
+    self.red_light_time = self.previous_bus_positions[-1].recorded_at
 
   #called when a bus's lights are turned green, when it's time to get ready to go to the bus
   def near(self):
-    self.green_light_time = self.previous_bus_positions[-1]['recorded_at']
+    self.green_light_time = self.previous_bus_positions[-1].recorded_at
 
 #TODO: erase all of this below here (at this indent level)
 
@@ -406,7 +380,7 @@ class Bus:
 
   def get_speed_mps(self):
     #meters per second
-    # this is a rolling weighted average over the past distance_to_track time/position values
+    # this is a rolling weighted average over the past speed_history_length time/position values
     if len(self.time_location_pairs) < 2:
       return default_bus_speed
 
@@ -461,7 +435,7 @@ class Bus:
     return distance / float(time.seconds)
 
 def preprocess_trajectory(traj):
-  """Transform/preprocess a trajectory somehow for use in the kmeans algo"""
+  """Transform/preprocess a trajectory (or, along the last axis, an array of them) somehow for use in the kmeans algo"""
   new_traj = list(traj)
   # old = list(traj[0:len(traj)/3])
   # medium = list(traj[len(traj)/3:(2*len(traj))/3])
@@ -471,40 +445,113 @@ def preprocess_trajectory(traj):
   # # new_traj = old + medium * 2 + new * 3
 
   # new_traj = [(o / 3.0) for o in old] + [(o / 2.0) for o in old] + new
-  new_traj = traj[-8:]
+  new_traj = traj[..., -8:]
   # try scaling down the first few
   return new_traj
 
 
-def find_similar_by_kmeans(truncated_trajectories, truncated_segment_intervals, number_of_clusters=144):
-  print("kmeansing")
-  centroids,_ = kmeans(truncated_trajectories, number_of_clusters) 
-  print("vqing")
-  cluster_indices,_ = vq(truncated_trajectories,centroids)
-  print("vqing again")
-  my_cluster_indices, _ = vq(array([truncated_segment_intervals]), centroids)
-  my_cluster_index = my_cluster_indices[0]
-  print("done with ML")
-  logging.debug("clusters: [%(sizes)s]" % 
-    {"sizes": ', '.join([str(cluster_indices.tolist().count(idx)) + ("*" if idx == my_cluster_index else "") for idx in set(sorted(cluster_indices))])})
-  
-  similar_trajectory_indexes = [i for i in range(0, len(cluster_indices)) if cluster_indices[i] == my_cluster_index]
-
-  # #find the suspiciously-large cluster... that might be the problem
-  # large_cluster_indices = [idx for idx in set(sorted(cluster_indices)) if cluster_indices.tolist().count(idx) > 1000] 
-  # for i, traj in enumerate(trajs):
-  #   if cluster_indices[i] in large_cluster_indices:
-  #     if rand() > 0.995:  #5 in 1000
-  #       logging.debug("large cluster member: " + str(traj))
-  return similar_trajectory_indexes
-
-def find_similar_by_k_nearest_neighbors(truncated_trajectories, truncated_segment_intervals, k=None):
+def no_prediction():
+  return {'similar': [], 'seconds_away': -1}
+
+def find_similar_trajectories_for(buses, number_of_clusters=144):
+  """Bus.find_similar_trajectories for several buses (all headed to the same stop) at once.
+
+     Buses in the same time bucket and at the same point along the route share a fitted index, so
+     they're grouped together and looked up with one kneighbors call. Returns each bus's result,
+     in the same order as buses.
+  """
+  results = {}
+  groups = OrderedDict() # (bucket, last_defined_segment_index) -> [(bus, query row)]
+  store = None
+  for bus in buses:
+    store = store or trajectorystore.store_for(bus.route_name, bus.end_stop_id, bus.db_session)
+    prediction_key = bus.prediction_key_for(store)
+    if prediction_key == bus.prediction_key:
+      # hasn't gotten to another stop since last time, so the same trajectories are still the most similar.
+      results[bus] = bus.memoized_prediction
+      continue
+    bus.prediction_key = prediction_key
+    query = bus.similarity_query(store)
+    if query is None:
+      bus.memoized_prediction = no_prediction()
+      results[bus] = bus.memoized_prediction
+      continue
+    candidates, last_defined_segment_index, truncated_segment_intervals = query
+    bucket = time_bucket(bus.start_time) if bus.start_time is not None else None
+    groups.setdefault((bucket, last_defined_segment_index), []).append((bus, candidates, truncated_segment_intervals))
+
+    # this "backup" method was in use until 1/15/15  (Next 19 lines)
+    # backoff: if there's tons of trajectories, make a maximum of N clusters (max_clusters)
+    # if N clusters would make "my" cluster contain M trajectories and M < minimum_similar_trajectories
+    #   then try again with N_2 as N_1 / 2
+    # 
+    # How did I compute max_clusters? 
+    # count of time_periods * count of weather variables * weekday_types * 4
+    # time_periods = early-morning-rush, late-morning-rush, late-morning, early-afternoon, mid-afternoon, early-evening-rush, late-evening-rush, late-evening, overnight
+    # weather_variables: hot, cold, rainy, snowy
+    # weekday_types: weekday, weekend
+    # max_clusters = 288
+    # minimum_similar_trajectories = 5
+    # similar_trajectories = self.filter_by_segment_intervals(similar_trajectories_by_time, max_clusters)
+    # clusters_cnt = max_clusters
+    # while clusters_cnt > 1 and len(similar_trajectories) < minimum_similar_trajectories and len(similar_trajectories) > 0:
+    #   # logging.debug(' '.join(map(str, ["backing off, with cluster count", clusters_cnt, "too few similar trajectories", len(similar_trajectories), "from",len(similar_trajectories_by_time), "total"])))
+    #   clusters_cnt = clusters_cnt / 2
+    #   similar_trajectories = self.filter_by_segment_intervals(similar_trajectories_by_time, clusters_cnt)
+  for (bucket, last_defined_segment_index), members in groups.items():
+    candidates = members[0][1] # the same for everyone in the bucket
+    bus = members[0][0]
+    end_segment_index = store.lengths[candidates[0]]
+    if similarity_method == 'kmeans':
+      clusters = trajectoryclusters.clusters_for(store, bucket, last_defined_segment_index, candidates,
+                      lambda rows: preprocess_trajectory(store.segments[rows, :last_defined_segment_index].astype(float)),
+                      bus.db_session, number_of_clusters)
+      similar_rows = [clusters.similar(row) for _, _, row in members]
+    elif similarity_method == 'kprototypes':
+      prototypes = trajectoryprototypes.prototypes_for(store, last_defined_segment_index,
+                      lambda rows: (preprocess_trajectory(store.segments[rows, :last_defined_segment_index].astype(float)),
+                                    vstack([store.weekdays[rows], store.time_buckets[rows]]).T),
+                      bus.db_session, number_of_clusters)
+      similar_rows = [prototypes.similar(row, [member.start_time.weekday(), bucket] if member.start_time is not None else None) for member, _, row in members]
+      # they can be from buckets where the route's a different length; only the ones that go all the way count
+      similar_rows = [similar[store.lengths[similar] >= end_segment_index] for similar in similar_rows]
+    else:
+      rows, end_segment_index, nbrs = trajectorystore.fitted_indexes.get((bus.route_name, bus.end_stop_id, bucket, last_defined_segment_index),
+                      store.version_of(bucket), lambda: fit_similar_trajectories(store, candidates, last_defined_segment_index))
+      similar_rows = [rows[indexes] for indexes in find_similar_by_k_nearest_neighbors(None, vstack([row for _, _, row in members]), nbrs=nbrs, each=True)]
+    for (bus, _, _), similar in izip(members, similar_rows):
+      bus.memoized_prediction = results[bus] = bus.predict_from(store, similar, last_defined_segment_index, end_segment_index)
+  return [results[bus] for bus in buses]
+
+def truncate_trajectories(store, candidates):
+  """The candidate rows of the store, cut off where the first of them ends."""
+  truncate_trajs_to = store.lengths[candidates[0]]
+  return store.segments[candidates, :truncate_trajs_to]
+
+def fit_similar_trajectories(store, candidates, last_defined_segment_index):
+  """The candidates, where they end, and a nearest-neighbors index of their first last_defined_segment_index segments."""
+  trajs = truncate_trajectories(store, candidates)
+  return (candidates, trajs.shape[1], fit_k_nearest_neighbors(preprocess_trajectory(trajs[:, :last_defined_segment_index])))
+
+def fit_k_nearest_neighbors(truncated_trajectories, k=None):
   if not k:
     #k = int(len(truncated_trajectories)**0.5)
     k = 10
   k = min(k, len(truncated_trajectories))
-  nbrs = NearestNeighbors(n_neighbors=k, algorithm='ball_tree').fit(truncated_trajectories)
+  if approximate_neighbors_above is not None and len(truncated_trajectories) > approximate_neighbors_above:
+    return RandomProjectionIndex(n_neighbors=k, tables=approximate_tables).fit(truncated_trajectories)
+  return NearestNeighbors(n_neighbors=k, algorithm='ball_tree').fit(truncated_trajectories)
+
+def find_similar_by_k_nearest_neighbors(truncated_trajectories, truncated_segment_intervals, k=None, nbrs=None, each=False):
+  """Indexes of the k trajectories nearest truncated_segment_intervals. Pass an already-fitted nbrs to skip fitting one.
+
+     With each, truncated_segment_intervals is a matrix with a row per query, and you get a list of indexes per row.
+  """
+  if nbrs is None:
+    nbrs = fit_k_nearest_neighbors(truncated_trajectories, k)
   distances, indices = nbrs.kneighbors(array(truncated_segment_intervals))
+  if each:
+    return indices
   my_nearest_neighbors_indices = indices[0]
   # indices is, for each point in the argument, a list of the index of its nearest neighbors
   # in, presumably, what was sent to fit.    
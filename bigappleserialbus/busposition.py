@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+__author__ = 'Jeremy B. Merrill'
+__email__ = 'jeremybmerrill@gmail.com'
+__license__ = 'Apache'
+__version__ = '0.1'
+
+history_length = 4 # positions kept per bus; Bus only ever looks at the last one
+
+class BusPosition(object):
+  """Where a bus was when it reported in: just the parts of a siri.Visit that Bus looks at again.
+
+     __slots__, rather than a dict per report, since every bus on every route we watch keeps some.
+  """
+  __slots__ = ('recorded_at', 'next_stop', 'distance_along_route', 'distance_to_end', 'is_at_stop', 'is_underway')
+
+  def __init__(self, recorded_at, next_stop, distance_along_route, distance_to_end, is_at_stop, is_underway=False):
+    self.recorded_at = recorded_at
+    self.next_stop = next_stop # stop ref
+    self.distance_along_route = distance_along_route
+    self.distance_to_end = distance_to_end
+    self.is_at_stop = is_at_stop
+    self.is_underway = is_underway
+
+  def __repr__(self):
+    return "<BusPosition %(next_stop)s %(dist)sm to go at %(time)s>" % {'next_stop': self.next_stop, 'dist': self.distance_to_end, 'time': self.recorded_at}
+
+class PositionHistory(object):
+  """A bus's last few BusPositions, oldest first, indexed like a list (history[-1] is the latest).
+
+     A ring buffer: once it has `length`, each new position overwrites the oldest, so a bus tracked
+     all day takes no more memory than one that just showed up.
+  """
+  __slots__ = ('positions', 'start', 'count')
+
+  def __init__(self, length=history_length):
+    self.positions = [None] * length
+    self.start = 0 # where the oldest one is
+    self.count = 0
+
+  def append(self, position):
+    length = len(self.positions)
+    self.positions[(self.start + self.count) % length] = position
+    if self.count < length:
+      self.count += 1
+    else:
+      self.start = (self.start + 1) % length
+
+  def __len__(self):
+    return self.count
+
+  def __getitem__(self, index):
+    if index < 0:
+      index += self.count
+    if not 0 <= index < self.count:
+      raise IndexError("position history index out of range")
+    return self.positions[(self.start + index) % len(self.positions)]
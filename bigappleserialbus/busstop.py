@@ -6,15 +6,15 @@ __license__ = 'Apache'
 __version__ = '0.1'
 
 import os
-import json
-import urllib2
-from httplib import BadStatusLine
 from datetime import datetime, timedelta
 import time
-from socket import error as SocketError
-from bus import Bus
+from bus import Bus, find_similar_trajectories_for
+import trajectorystore
 from trajectory import Trajectory, Base
 from operator import attrgetter
+import bustime
+import siri
+import capturelog
 
 from sqlalchemy import Column, ForeignKey, Integer, String, Text
 from sqlalchemy import orm
@@ -27,13 +27,25 @@ import logging #magically the same as the one in bigappleserialbus.py
 from onpi import is_on_pi
 write_bustime_responses_for_debug = False #is_on_pi()
 
-read_bustime_data_from_disk = (not is_on_pi()) and len(os.listdir(os.path.join(os.path.dirname(__file__), '..', 'debugjson'))) > 65
+read_bustime_data_from_disk = (not is_on_pi()) and len(capturelog.CaptureReader().segments()) > 0
+capture_writer = capturelog.CaptureWriter() if write_bustime_responses_for_debug else None
 
 
 time_to_get_ready = 240 # seconds
 time_to_go = 180 #seconds
 seconds_to_sidewalk = 60 #seconds
 
+# how often to poll BusTime for a stop; see seconds_until_next_check
+min_between_checks = 10 #seconds; buses only report their position every 30 seconds or so anyway
+default_between_checks = 15 #seconds; what the MTA's own bustime website does
+max_between_checks = 90 #seconds
+
+# A bus whose segment-time estimate (see Bus.segment_time_prediction) puts it this far past
+# time_to_get_ready, even if it beats the median by as much as the 80th percentile trails it, gets
+# that estimate instead of a similarity search: it's nowhere near changing a light, so it doesn't
+# need the search's accuracy. None to always search.
+estimate_beyond_time_to_get_ready = 120 #seconds
+
 green_notice = green_code + "[green]" + end_color + " "
 red_notice = red_code + "[red]" + end_color + " "
 fail_notice = yellow_code + "[FAIL]" + end_color + " "
@@ -43,10 +55,6 @@ mta_api_key = open(apikey_path, 'r').read().strip()
 
 errors = {}
 
-class TestCompleteException(Exception):
-  pass 
-
-
 # store in database green-light-on times and  actual arrival times
 # to calculate avg error
 class BusStop(Base):
@@ -85,33 +93,47 @@ class BusStop(Base):
     self.bus_is_near = False
     self.bus_is_imminent = False
     self.status_error = False
-    if read_bustime_data_from_disk:
-      files_for_this_stop = [f for f in os.listdir(os.path.join(os.path.dirname(__file__), '..', 'debugjson')) if f.split('.')[0] == self.route_name and f.split('.')[1] == self.stop_id]
-      self.test_json = [os.path.join(os.path.dirname(__file__), '..', 'debugjson', name) for name in sorted(files_for_this_stop, reverse=True)]
-
-  def check(self):
-    vehicle_activities, check_timestamp, success = self.get_locations()
+    self.predicted_seconds_away = []
+    self.next_check_at = 0 # time.time() after which this stop wants fresh data
+    self.vehicles_seen = None # (VehicleRef, RecordedAtTime) pairs from the last check
+
+  def check(self, locations=None):
+    """Update buses and lights from a get_locations() result, fetching one if none is given."""
+    if locations is None:
+      locations = self.get_locations()
+    visits, check_timestamp, success = locations
     if not success:
-      self.status_error
-      logging.debug("get locatoins failed")
+      self.status_error = True
+      logging.debug("get locations failed")
       return []
+    self.status_error = False
+
+    # if no bus has reported since last time (and none have come or gone), there's nothing to update.
+    vehicles_seen = sorted([(visit.vehicle_ref, visit.recorded_at) for visit in visits])
+    if vehicles_seen == self.vehicles_seen:
+      logging.debug("no new data for %(route_name)s/%(stop_id)s" % {'route_name': self.route_name, 'stop_id': self.stop_id})
+      return []
+    self.vehicles_seen = vehicles_seen
+
     self.bus_is_imminent = False
     self.bus_is_near = False
     new_buses = {}
     trajectories = []
+    moved_vehicle_refs = set()
 
     #populate new buses and add their position.
-    for activity in vehicle_activities:
-      journey = activity["MonitoredVehicleJourney"]
-
-      vehicle_ref = journey["VehicleRef"]
+    for visit in visits:
+      vehicle_ref = visit.vehicle_ref
       if vehicle_ref in self.buses_on_route:
         new_buses[vehicle_ref] = self.buses_on_route[vehicle_ref]
       else:
-        new_buses[vehicle_ref] = Bus(vehicle_ref, journey, self.route_name, self.stop_id, self.db_session)
+        new_buses[vehicle_ref] = Bus(vehicle_ref, visit, self.route_name, self.stop_id, self.db_session)
       active_bus = new_buses[vehicle_ref]
 
-      active_bus.add_observed_position(journey, activity["RecordedAtTime"])
+      # a bus that hasn't reported since the last check keeps its position and prediction.
+      if active_bus.last_recorded_at_str != visit.recorded_at:
+        active_bus.add_observed_position(visit)
+        moved_vehicle_refs.add(vehicle_ref)
     logging.debug(self.route_name + " buses: " + ("["+', '.join(map(lambda x: repr(x), new_buses.values())) + "]" if new_buses.values() else "[]"))
 
     #for buses that just passed us (and that ever got close enough to have a projected arrival time):
@@ -123,8 +145,8 @@ class BusStop(Base):
         # when we never get a bus's data right when it arrives at the final stop, 
         # instead, it just disappears. We need to interpolate that last position
         # uses the latest recorded_at, because that's probably the best guess we have as to when the bus arrived at our stop.
-        if vehicle_activities:
-          most_recent_time = sorted([activity["RecordedAtTime"] for activity in vehicle_activities])[-1]
+        if visits:
+          most_recent_time = sorted([visit.recorded_at for visit in visits])[-1]
         else:
           most_recent_time = check_timestamp
         bus_past_stop.fill_in_last_stop(most_recent_time)
@@ -167,8 +189,11 @@ class BusStop(Base):
         trajectories.append(bus_trajectory) #calculate the right columns.
     
     self.buses_on_route = new_buses
+    self.predicted_seconds_away = []
+    self.find_similar_trajectories([bus for vehicle_ref, bus in self.buses_on_route.items()
+                                      if vehicle_ref in moved_vehicle_refs or bus.similar_trajectories is None])
     for vehicle_ref, bus in self.buses_on_route.items():
-      similar_trajectories = bus.find_similar_trajectories()
+      similar_trajectories = bus.similar_trajectories
 
       similar_seconds_away = similar_trajectories['seconds_away']
       speeds_seconds_away = bus.get_seconds_away() # instant speed-based: str(bus.get_minutes_away())[2:7]
@@ -182,9 +207,14 @@ class BusStop(Base):
         # it might be the case that this is the first trajectory we've seen for this bus! save it.
         continue
       else:
-        logging.debug("bus %(name)s/%(veh)s: %(secsim)s away from %(cnt)i similar trajectories" % 
-          {'name': self.route_name, 'secsim': str(seconds_to_minutes(similar_seconds_away))[2:8],
-           'cnt':len(similar_trajectories['similar']), 'veh': vehicle_ref })
+        self.predicted_seconds_away.append(similar_seconds_away)
+        if 'p80_seconds_away' in similar_trajectories:
+          logging.debug("bus %(name)s/%(veh)s: %(secsim)s away from segment times" % 
+            {'name': self.route_name, 'secsim': str(seconds_to_minutes(similar_seconds_away))[2:8], 'veh': vehicle_ref })
+        else:
+          logging.debug("bus %(name)s/%(veh)s: %(secsim)s away from %(cnt)i similar trajectories" % 
+            {'name': self.route_name, 'secsim': str(seconds_to_minutes(similar_seconds_away))[2:8],
+             'cnt':len(similar_trajectories['similar']), 'veh': vehicle_ref })
 
       if similar_seconds_away < self.too_late_to_catch_the_bus:
         # too close, won't make it.
@@ -226,6 +256,56 @@ class BusStop(Base):
     self.prep_for_writing()
     return trajectories
 
+  def find_similar_trajectories(self, buses):
+    """Set each of buses' similar_trajectories, predicting for all of them in one batch.
+
+       Buses that are far enough away (see estimate_beyond_time_to_get_ready) get their segment-time
+       estimate instead, and aren't searched.
+    """
+    searched = []
+    for bus in buses:
+      estimate = self.far_away_estimate(bus)
+      if estimate is not None:
+        bus.similar_trajectories = estimate
+      else:
+        searched.append(bus)
+    for bus, similar_trajectories in zip(searched, find_similar_trajectories_for(searched)):
+      bus.similar_trajectories = similar_trajectories
+
+  def far_away_estimate(self, bus):
+    """bus's segment-time prediction, if even an early arrival by it is past estimate_beyond_time_to_get_ready; otherwise None."""
+    if estimate_beyond_time_to_get_ready is None:
+      return None
+    estimate = bus.segment_time_prediction(trajectorystore.store_for(self.route_name, self.stop_id, self.db_session))
+    if estimate is None:
+      return None
+    early = 2 * estimate['seconds_away'] - estimate['p80_seconds_away'] # as far below the median as the p80 is above it
+    if early <= self.time_to_get_ready + estimate_beyond_time_to_get_ready:
+      return None
+    return estimate
+
+  def seconds_until_next_check(self):
+    """How long to wait before polling this stop again, based on the buses' predicted arrivals.
+
+       We want fresh data right before a bus flips a light (green on, red on, red off), and not 
+       much at all when every bus is far outside time_to_get_ready. So wait half the time until 
+       the soonest light change, within min_between_checks and max_between_checks.
+    """
+    light_changes = [self.time_to_get_ready, self.time_to_go, self.too_late_to_catch_the_bus]
+    seconds_to_light_changes = [seconds_away - light_change for seconds_away in self.predicted_seconds_away
+                                  for light_change in light_changes if seconds_away > light_change]
+    if seconds_to_light_changes:
+      wait = min(seconds_to_light_changes) / 2.0
+    else:
+      wait = max_between_checks
+    if len(self.predicted_seconds_away) < len(self.buses_on_route):
+      # some buses don't have a prediction yet, so we don't know when they'll flip the lights.
+      wait = min(wait, default_between_checks)
+    return max(min_between_checks, min(max_between_checks, wait))
+
+  def schedule_next_check(self, now):
+    self.next_check_at = now + self.seconds_until_next_check()
+
   def prep_for_writing(self):
     #TODO: figure out a cleaner way to do this.
     self.errors = filter(lambda x: abs(x) < 3000, self.errors) #errors that big are spurious
@@ -236,65 +316,27 @@ class BusStop(Base):
     # http://api.prod.obanyc.com/api/siri/stop-monitoring.json?key=whatever&LineRef=MTA%20NYCT_B65
     # stop
     # http://api.prod.obanyc.com/api/siri/stop-monitoring.json?key=whatever&MonitoringRef=306495&LineRef=MTA%20NYCT_B65
+    # (when running for real, RouteFetcher gets every stop on a route in one VehicleMonitoring request instead.)
 
-    requestUrl = "http://bustime.mta.info/api/siri/stop-monitoring.json?key=%(key)s&OperatorRef=MTA&MonitoringRef=%(stop)s&StopMonitoringDetailLevel=%(onw)s" %\
+    requestPath = "/api/siri/stop-monitoring.json?key=%(key)s&OperatorRef=MTA&MonitoringRef=%(stop)s&StopMonitoringDetailLevel=%(onw)s" %\
             {'key': self.mta_key, 'stop': self.stop_id, 'onw': 'calls'}
     # logging.debug("locations: " + requestUrl)
-    resp = None
-    if read_bustime_data_from_disk:
-      try:
-        print(len(self.test_json))
-        with open(self.test_json.pop(), 'r') as jsonfile:
-          resp = json.loads(jsonfile.read())
-      except IndexError:
-        raise TestCompleteException("test finished successfully")
-    else: 
-      for i in xrange(0,4):
-        try:
-          response = urllib2.urlopen(requestUrl)
-          #this only happens if the attempt to get the data fails 4 times.
-          if not response:
-            raise urllib2.URLError("Couldn't reach BusTime servers...")
-
-          jsonresp = response.read()
-          try: 
-            resp = json.loads(jsonresp)
-          except ValueError:
-            raise urllib2.URLError("Bad JSON: " + jsonresp)
-          except Exception as e:
-            raise e
-          finally:
-            if i > 0:
-              logging.debug("getting data failed before, but worked this time")
-            break
-        except (urllib2.URLError, SocketError, BadStatusLine) as e: 
-          logging.debug("getting data failed, trying again (%(i)i/4)" % {'i': i+1})
-          response = None
-          resp = None
-          if i == 3:
-            logging.debug("getting data failed 4 times (except->if branch)")
-            return (None, None, False)
-          time.sleep(10 * i)
-      else:
-        logging.debug("getting data failed 4 times (else branch)")
-        return (None, None, False)
+    jsonresp = bustime.get(requestPath)
+    if jsonresp is None:
+      return (None, None, False)
     try:
-      vehicle_activities = resp["Siri"]["ServiceDelivery"]["StopMonitoringDelivery"][0]["MonitoredStopVisit"]
-    except Exception as e:
-      logging.debug(resp)
-      raise e
-    try:
-      check_timestamp = resp["Siri"]["ServiceDelivery"]["ResponseTimestamp"]
-    except Exception as e:
-      logging.debug(resp)
-      raise e
+      check_timestamp, visits = siri.read_stop_monitoring(jsonresp)
+    except ValueError as e:
+      logging.debug("bad BusTime response: " + str(e))
+      return (None, None, False)
 
     if write_bustime_responses_for_debug:
-      filename = self.route_name + "." + self.stop_id + "." + check_timestamp + ".json"
-      filepath = os.path.join(os.path.dirname(__file__), "..", "debugjson", filename)
-      with open(filepath, 'w') as f:
-        f.write(jsonresp)
-    return (vehicle_activities, check_timestamp, True)
+      self.capture_response(jsonresp, check_timestamp)
+    return (visits, check_timestamp, True)
+
+  def capture_response(self, jsonresp, check_timestamp):
+    """Save a stop-monitoring response to the capture log, for replay.py."""
+    capture_writer.append(self.route_name, self.stop_id, check_timestamp, jsonresp)
 
   def status(self):
     if self.status_error:
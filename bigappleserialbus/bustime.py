@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+__author__ = 'Jeremy B. Merrill'
+__email__ = 'jeremybmerrill@gmail.com'
+__license__ = 'Apache'
+__version__ = '0.1'
+
+import time
+import zlib
+import urllib2
+import httplib
+from Queue import LifoQueue, Empty, Full
+from threading import Lock
+from socket import error as SocketError
+
+import logging #magically the same as the one in bigappleserialbus.py
+
+bustime_host = "bustime.mta.info"
+request_timeout = 20 #seconds
+max_idle_connections = 4 # about one per route we're fetching in parallel
+
+class BusTimeClient:
+  """Shared HTTP client for the BusTime API.
+
+     Connections are kept alive and reused across stops and ticks (TCP setup over the Pi's WiFi
+     costs more than the request itself), responses are requested gzipped, and every request's
+     timing is logged, along with running totals.
+  """
+  def __init__(self, host, timeout=request_timeout, max_idle=max_idle_connections):
+    self.host = host
+    self.timeout = timeout
+    self.idle_connections = LifoQueue(max_idle)
+    self.lock = Lock() # the fetch pool's threads all update the totals
+    self.requests = 0
+    self.new_connections = 0
+    self.seconds = 0.0
+    self.bytes_received = 0
+    self.bytes_decoded = 0
+
+  def get(self, path):
+    """GET path from the BusTime host and return the (decompressed) body.
+
+       Raises urllib2.URLError on a non-200 response, and lets socket/httplib/zlib errors through.
+    """
+    start = time.time()
+    connection, reused = self.checkout()
+    try:
+      response, body = self.send(connection, path)
+    except (httplib.HTTPException, SocketError):
+      connection.close()
+      if not reused:
+        raise
+      # the server is allowed to close a kept-alive connection whenever it likes, so try once more on a fresh one.
+      connection, reused = self.connect(), False
+      try:
+        response, body = self.send(connection, path)
+      except (httplib.HTTPException, SocketError):
+        connection.close()
+        raise
+
+    if response.will_close:
+      connection.close()
+    else:
+      self.checkin(connection)
+
+    decoded = decompress(body, response.getheader('content-encoding', ''))
+    self.record(path, time.time() - start, len(body), len(decoded), reused)
+    if response.status != 200:
+      raise urllib2.URLError("BusTime returned HTTP %(status)i" % {'status': response.status})
+    return decoded
+
+  def send(self, connection, path):
+    connection.request("GET", path, headers={"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"})
+    response = connection.getresponse()
+    return (response, response.read())
+
+  def connect(self):
+    with self.lock:
+      self.new_connections += 1
+    return httplib.HTTPConnection(self.host, timeout=self.timeout)
+
+  def checkout(self):
+    """Returns an idle connection if there is one, else a new one, and whether it was reused."""
+    try:
+      return (self.idle_connections.get_nowait(), True)
+    except Empty:
+      return (self.connect(), False)
+
+  def checkin(self, connection):
+    try:
+      self.idle_connections.put_nowait(connection)
+    except Full:
+      connection.close()
+
+  def record(self, path, seconds, bytes_received, bytes_decoded, reused):
+    with self.lock:
+      self.requests += 1
+      self.seconds += seconds
+      self.bytes_received += bytes_received
+      self.bytes_decoded += bytes_decoded
+      totals = {'avg_ms': (self.seconds / self.requests) * 1000, 'count': self.requests, 'new': self.new_connections,
+                'ratio': float(self.bytes_decoded) / max(self.bytes_received, 1)}
+    # the query string has our API key in it, so leave it out of the log.
+    logging.debug("GET %(path)s: %(ms)ims, %(kb).1fkB (%(decoded_kb).1fkB decoded) on a %(conn)s connection; %(avg_ms)ims avg over %(count)i requests, %(new)i connections, %(ratio).1fx compression" %
+      {'path': path.split('?')[0], 'ms': seconds * 1000, 'kb': bytes_received / 1024.0, 'decoded_kb': bytes_decoded / 1024.0,
+       'conn': 'reused' if reused else 'new', 'avg_ms': totals['avg_ms'], 'count': totals['count'],
+       'new': totals['new'], 'ratio': totals['ratio'] })
+
+def decompress(body, content_encoding):
+  if content_encoding == 'gzip':
+    return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+  if content_encoding == 'deflate':
+    # "deflate" is supposed to be zlib-wrapped, but plenty of servers send it raw.
+    try:
+      return zlib.decompress(body)
+    except zlib.error:
+      return zlib.decompress(body, -zlib.MAX_WBITS)
+  return body
+
+client = BusTimeClient(bustime_host)
+
+def get(path):
+  """GET a BusTime API path. Returns the response body, or None if that failed (including if it
+     was truncated or corrupted past decompressing). (See siri.py to decode it.)
+
+     This doesn't retry; failed fetches go on BigAppleSerialBus's RetryQueue rather than holding up the tick.
+  """
+  try:
+    return client.get(path)
+  except (urllib2.URLError, SocketError, httplib.HTTPException, zlib.error) as e:
+    logging.debug("getting data failed: " + str(e))
+    return None
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+__author__ = 'Jeremy B. Merrill'
+__email__ = 'jeremybmerrill@gmail.com'
+__license__ = 'Apache'
+__version__ = '0.1'
+
+import os
+import sys
+import zlib
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from datetime import datetime, timedelta
+from threading import Lock
+
+import logging #magically the same as the one in bigappleserialbus.py
+
+# Saved BusTime responses, for replaying later (see read_bustime_data_from_disk in busstop.py).
+#
+# There's one segment per route per day: <route>.<YYYY-MM-DD>.seg holds each stop-monitoring response,
+# zlib-compressed, one after another; <route>.<YYYY-MM-DD>.idx has a line per response saying when it
+# was from and where it is in the segment:
+#   <seconds since the epoch>\t<offset>\t<length>\t<stop_id>\t<ResponseTimestamp>
+# Both files are only ever appended to. A response goes in the segment before its index line does, so
+# if we die halfway through a write, the segment just ends in a few bytes nothing points to.
+captures_path = os.path.join(os.path.dirname(__file__), "..", "captures")
+segment_extension = ".seg"
+index_extension = ".idx"
+
+Capture = namedtuple('Capture', ['route_name', 'stop_id', 'check_timestamp', 'seconds', 'body'])
+IndexEntry = namedtuple('IndexEntry', ['seconds', 'offset', 'length', 'stop_id', 'check_timestamp'])
+
+class CaptureWriter:
+  """Appends responses to the capture log. Safe to share between RouteFetcher's worker threads."""
+  def __init__(self, directory=captures_path):
+    self.directory = directory
+    self.lock = Lock()
+    self.open_segments = {} # route_name -> (day, segment file, index file)
+
+  def append(self, route_name, stop_id, check_timestamp, body):
+    compressed = zlib.compress(body, 9)
+    day = check_timestamp[0:10]
+    with self.lock:
+      segment, index = self.files_for(route_name, day)
+      offset = segment.tell()
+      segment.write(compressed)
+      segment.flush()
+      index.write("%(seconds).3f\t%(offset)i\t%(length)i\t%(stop_id)s\t%(ts)s\n" %
+        {'seconds': timestamp_to_seconds(check_timestamp), 'offset': offset, 'length': len(compressed),
+         'stop_id': stop_id, 'ts': check_timestamp})
+      index.flush()
+
+  def files_for(self, route_name, day):
+    if route_name in self.open_segments:
+      open_day, segment, index = self.open_segments[route_name]
+      if open_day == day:
+        return (segment, index)
+      # a new day, so a new segment; yesterday's is done.
+      segment.close()
+      index.close()
+    if not os.path.exists(self.directory):
+      os.makedirs(self.directory)
+    segment = open(segment_path(self.directory, route_name, day), 'ab')
+    segment.seek(0, os.SEEK_END) # so tell() is right before the first write
+    index = open(segment_path(self.directory, route_name, day, index_extension), 'a')
+    self.open_segments[route_name] = (day, segment, index)
+    return (segment, index)
+
+  def close(self):
+    with self.lock:
+      for _, segment, index in self.open_segments.values():
+        segment.close()
+        index.close()
+      self.open_segments = {}
+
+class CaptureReader:
+  """Reads responses back out of the capture log, in time order, starting wherever you like."""
+  def __init__(self, directory=captures_path):
+    self.directory = directory
+
+  def segments(self, route_name=None):
+    """Returns (route_name, day) for each segment, oldest first."""
+    if not os.path.isdir(self.directory):
+      return []
+    segments = []
+    for filename in os.listdir(self.directory):
+      if filename.endswith(index_extension):
+        segment_route, day = filename[:-len(index_extension)].split('.')
+        if route_name is None or segment_route == route_name:
+          segments.append((segment_route, day))
+    return sorted(segments, key=lambda segment: (segment[1], segment[0]))
+
+  def index(self, route_name, day):
+    """A segment's IndexEntries, sorted by time."""
+    entries = []
+    with open(segment_path(self.directory, route_name, day, index_extension), 'r') as index:
+      for line in index:
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) != 5:
+          continue # torn last line from a crash mid-write
+        entries.append(IndexEntry(float(fields[0]), int(fields[1]), int(fields[2]), fields[3], fields[4]))
+    entries.sort(key=lambda entry: entry.seconds) # stable, so responses from the same second stay in the order they came
+    return entries
+
+  def read(self, route_name, stop_id=None, since=None, until=None):
+    """Yields a Capture for each response for route_name (and stop_id, if given) from since up to until.
+
+       since and until are seconds since the epoch. Each segment's index is bisected to find where
+       to start, so only the responses asked for are ever read or decompressed.
+    """
+    for segment_route, day in self.segments(route_name):
+      if until is not None and day_to_seconds(day) > until + seconds_in_a_day:
+        break
+      if since is not None and day_to_seconds(day) + 2 * seconds_in_a_day < since:
+        continue # a day's responses all fall within a day and a bit of its (UTC) midnight, whatever the timezone.
+      entries = self.index(segment_route, day)
+      times = [entry.seconds for entry in entries]
+      start = bisect_left(times, since) if since is not None else 0
+      end = bisect_right(times, until) if until is not None else len(entries)
+      if start >= end:
+        continue
+      with open(segment_path(self.directory, segment_route, day), 'rb') as segment:
+        for entry in entries[start:end]:
+          if stop_id is not None and entry.stop_id != stop_id:
+            continue
+          segment.seek(entry.offset)
+          body = zlib.decompress(segment.read(entry.length))
+          yield Capture(segment_route, entry.stop_id, entry.check_timestamp, entry.seconds, body)
+
+seconds_in_a_day = 24 * 60 * 60
+epoch = datetime(1970, 1, 1)
+
+def segment_path(directory, route_name, day, extension=segment_extension):
+  return os.path.join(directory, route_name + "." + day + extension)
+
+def timestamp_to_seconds(check_timestamp):
+  """Seconds since the epoch for a BusTime timestamp like 2014-11-19T08:40:19.553-05:00."""
+  local = datetime.strptime(check_timestamp[0:19], "%Y-%m-%dT%H:%M:%S")
+  fraction = float(check_timestamp[19:23]) if check_timestamp[19:20] == '.' else 0.0
+  offset = check_timestamp[-6:]
+  if offset[0] in '+-' and offset[3] == ':':
+    utc_offset = timedelta(hours=int(offset[1:3]), minutes=int(offset[4:6]))
+    local = local - utc_offset if offset[0] == '+' else local + utc_offset
+  return (local - epoch).total_seconds() + fraction
+
+def day_to_seconds(day):
+  return (datetime.strptime(day, "%Y-%m-%d") - epoch).total_seconds()
+
+def convert_debugjson(debugjson_path, directory=captures_path):
+  """Migrate a directory of <route>.<stop>.<timestamp>.json files (the old debug format) into the capture log.
+
+     Returns how many responses were converted.
+  """
+  responses = []
+  for filename in os.listdir(debugjson_path):
+    if not filename.endswith(".json"):
+      continue
+    parts = filename.split('.')
+    # the timestamp has a dot of its own, e.g. b45.MTA_303574.2014-11-19T08:40:19.553-05:00.json
+    responses.append((timestamp_to_seconds('.'.join(parts[2:-1])), parts[0], parts[1], '.'.join(parts[2:-1]), filename))
+  responses.sort()
+
+  writer = CaptureWriter(directory)
+  for _, route_name, stop_id, check_timestamp, filename in responses:
+    with open(os.path.join(debugjson_path, filename), 'rb') as jsonfile:
+      writer.append(route_name, stop_id, check_timestamp, jsonfile.read())
+  writer.close()
+  return len(responses)
+
+if __name__ == "__main__":
+  # python capturelog.py [debugjson directory]
+  debugjson_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__), "..", "debugjson")
+  count = convert_debugjson(debugjson_path)
+  print("converted %(count)i responses from %(from)s into %(to)s" % {'count': count, 'from': debugjson_path, 'to': captures_path})
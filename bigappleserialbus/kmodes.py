@@ -8,7 +8,9 @@ __email__ = 'njdevos@gmail.com'
 __license__ = 'MIT'
 __version__ = '0.8'
 
+import copy
 import random
+import multiprocessing
 import numpy as np
 from collections import defaultdict
 
@@ -38,18 +40,33 @@ class KModes(object):
         # init some variables
         self.membership = self.clusters = self.centroids = self.cost = None
 
+    # how many points to look ahead at once for ones that need to move (see _perform_clustering)
+    block_size = 64
+
     def cluster(self, x, pre_runs=10, pre_pctl=20, *args, **kwargs):
         """Shell around _perform_clustering method that tries to ensure a good clustering
         result by choosing one that has a relatively low clustering cost compared to the
         costs of a number of pre-runs. (Huang [1998] states that clustering cost can be
         used to judge the clustering quality.)
 
+        Keyword arguments n_jobs and seed run the pre-runs and the candidate runs after them
+        on a pool of n_jobs processes (-1 for one per CPU), run i seeded with seed + i. The
+        first candidate, in seed order, that is good enough wins, so the result only depends
+        on the seed, not on n_jobs.
+
         """
+        n_jobs = kwargs.pop('n_jobs', 1)
+        seed = kwargs.pop('seed', None)
+        # the pre-runs are always quiet; verbose is for the runs after them
+        verbose = kwargs.pop('verbose', 1)
 
         if pre_runs and 'init_method' in kwargs and kwargs['init_method'] == 'Cao':
             print("Initialization method and algorithm are deterministic. Disabling preruns...")
             pre_runs = None
 
+        if n_jobs != 1 or seed is not None:
+            return self._cluster_seeded(x, pre_runs, pre_pctl, n_jobs, seed, args, kwargs)
+
         if pre_runs:
             precosts = np.empty(pre_runs)
             for pr in range(pre_runs):
@@ -61,17 +78,57 @@ class KModes(object):
             goodcost = np.inf
 
         while True:
-            self._perform_clustering(x, *args, verbose=1, **kwargs)
+            self._perform_clustering(x, *args, verbose=verbose, **kwargs)
             if self.cost <= goodcost:
                 break
 
-    def _perform_clustering(self, x, init_method='Huang', max_iters=100, verbose=1):
+    def _cluster_seeded(self, x, pre_runs, pre_pctl, n_jobs, seed, args, kwargs):
+        if seed is None:
+            seed = np.random.randint(2 ** 30)
+        if n_jobs < 1:
+            n_jobs = multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(n_jobs) if n_jobs > 1 else None
+
+        def runs(seeds):
+            # each is a copy of self, clustered (and, in this process, copied first, so runs don't share one)
+            return (pool.map if pool else map)(_seeded_run, [(copy.deepcopy(self), x, s, args, kwargs) for s in seeds])
+
+        try:
+            if pre_runs:
+                precosts = np.array([run.cost for run in runs(range(seed, seed + pre_runs))])
+                for pr in range(pre_runs):
+                    print("Prerun {0} / {1}, Cost = {2}".format(pr+1, pre_runs, precosts[pr]))
+                goodcost = np.percentile(precosts, pre_pctl)
+            else:
+                goodcost = np.inf
+
+            candidate_seed = seed + (pre_runs or 0)
+            while True:
+                for run in runs(range(candidate_seed, candidate_seed + n_jobs)):
+                    print("Run with seed {0}, Cost = {1}".format(candidate_seed, run.cost))
+                    if run.cost <= goodcost:
+                        self.__dict__.update(run.__dict__)
+                        return
+                    candidate_seed += 1
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+    def _perform_clustering(self, x, init_method='Huang', max_iters=100, verbose=1, batch=False):
         """Inputs:  x           = data points [no. points * no. attributes]
                     init_method = initialization method ('Huang' for the one described in
                                   Huang [1998], 'Cao' for the one in Cao et al. [2009])
                     max_iters   = maximum no. of iterations
                     verbose     = 0 for no and 1 for normal algorithm progress information,
                                   2 for internal algorithm details
+                    batch       = False to move points one at a time, updating the centroids
+                                  after each move (Huang [1998]); True to move every point
+                                  that's nearer another centroid at once, and update the
+                                  centroids once per iteration. Much quicker on a lot of
+                                  points, but from the same start it can come to different,
+                                  often costlier, clusters, so it's best with cluster()'s
+                                  pre-runs.
 
         """
         # convert to numpy array, if needed
@@ -90,21 +147,30 @@ class KModes(object):
 
         if verbose:
             print("Init: initializing clusters")
+        # the rest is done with each attribute's values numbered (see encode_categories), so the
+        # centroids are codes too; the centroids don't change until every point is assigned, so
+        # assign them all at once
+        self._codes, self._values = encode_categories(x)
+        self._attrs = np.arange(nattrs)
+        codes = self._codes
+        centroid_codes = np.empty((self.k, nattrs), dtype=codes.dtype)
+        for iattr in range(nattrs):
+            centroid_codes[:, iattr] = np.searchsorted(self._values[iattr], self.centroids[:, iattr])
+        labels = np.argmin(self.get_dissims(codes, centroid_codes), axis=1)
         self.membership = np.zeros((self.k, npoints), dtype='int64')
-        # self._clustAttrFreq is a list of lists with dictionaries that contain the
-        # frequencies of values per cluster and attribute
-        self._clustAttrFreq = [[defaultdict(int) for _ in range(nattrs)] for _ in range(self.k)]
-        for ipoint, curpoint in enumerate(x):
-            # initial assigns to clusters
-            cluster = np.argmin(self.get_dissim(self.centroids, curpoint))
-            self.membership[cluster, ipoint] = 1
-            # count attribute values per cluster
-            for iattr, curattr in enumerate(curpoint):
-                self._clustAttrFreq[cluster][iattr][curattr] += 1
-        # perform an initial centroid update
-        for ik in range(self.k):
-            for iattr in range(nattrs):
-                self.centroids[ik, iattr] = self.get_mode(self._clustAttrFreq[ik][iattr])
+        self.membership[labels, np.arange(npoints)] = 1
+        # self._clustAttrFreq[cluster, attribute, code] is how many points in the cluster have
+        # that code for that attribute
+        # (and _clustAttrFreqFlat is the same, with each cluster's counts in one row; _flatCodes
+        # are where each point's counts are in that row)
+        nvalues = self._values.shape[1]
+        self._flatCodes = self._attrs * nvalues + codes
+        self._clustAttrFreqFlat = np.bincount((labels[:, np.newaxis] * nattrs * nvalues + self._flatCodes).ravel(),
+                                              minlength=self.k * nattrs * nvalues).reshape(self.k, -1)
+        self._clustAttrFreq = self._clustAttrFreqFlat.reshape(self.k, nattrs, nvalues)
+        # perform an initial centroid update (empty clusters keep their initial centroids)
+        nonempty = np.flatnonzero(self.membership.any(axis=1))
+        centroid_codes[nonempty] = self.get_modes(nonempty)
 
         # ----------------------
         #    ITERATION
@@ -115,41 +181,71 @@ class KModes(object):
         converged = False
         while itr <= max_iters and not converged:
             itr += 1
+            if batch:
+                moves = self._move_batch(codes, labels, centroid_codes)
+                converged = (moves == 0)
+                if verbose:
+                    print("Iteration: {0}/{1}, moves: {2}".format(itr, max_iters, moves))
+                continue
             moves = 0
-            for ipoint, curpoint in enumerate(x):
-                cluster = np.argmin(self.get_dissim(self.centroids, curpoint))
-                # if necessary: move point, and update old/new cluster frequencies and centroids
-                if not self.membership[cluster, ipoint]:
+            # Each move changes two centroids, which can change where later points belong, so points
+            # still move one at a time, in order. But most points don't move, and most moves don't
+            # change a mode, so: find the points in a block that need to move all at once, and only
+            # look again when a centroid changes.
+            for start in range(0, npoints, self.block_size):
+                end = min(start + self.block_size, npoints)
+                dissims = self.get_dissims(codes[start:end], centroid_codes)
+                nearest = np.argmin(dissims, axis=1)
+                tomove = (np.flatnonzero(nearest != labels[start:end]) + start).tolist()
+                while tomove:
+                    ipoint = tomove.pop(0)
+                    cluster = nearest[ipoint - start]
+                    oldcluster = labels[ipoint]
+                    # move point, and update old/new cluster frequencies and centroids
                     moves += 1
-                    oldcluster = np.argwhere(self.membership[:, ipoint])[0][0]
-                    self._add_point_to_cluster(curpoint, ipoint, cluster)
-                    self._remove_point_from_cluster(curpoint, ipoint, oldcluster)
+                    self._move_point(ipoint, oldcluster, cluster)
+                    labels[ipoint] = cluster
                     # update new and old centroids by choosing most likely attribute
-                    for iattr, curattr in enumerate(curpoint):
-                        for curc in (cluster, oldcluster):
-                            self.centroids[curc, iattr] = self.get_mode(
-                                self._clustAttrFreq[curc][iattr])
+                    changed = False
+                    for curc in (cluster, oldcluster):
+                        modes = self._clustAttrFreq[curc].argmax(axis=1)
+                        if (modes != centroid_codes[curc]).any():
+                            centroid_codes[curc] = modes
+                            changed = True
+                    if changed:
+                        rest = slice(ipoint + 1 - start, end - start)
+                        dissims[rest] = self.get_dissims(codes[ipoint + 1:end], centroid_codes)
+                        nearest[rest] = np.argmin(dissims[rest], axis=1)
+                        tomove = (np.flatnonzero(nearest[rest] != labels[ipoint + 1:end]) + ipoint + 1).tolist()
                     if verbose == 2:
                         print("Move from cluster {0} to {1}".format(oldcluster, cluster))
 
                         # in case of an empty cluster, reinitialize with a random point
                         # that is not a centroid
                         if sum(self.membership[oldcluster, :]) == 0:
+                            self.centroids[:] = self.decode(centroid_codes)
                             while True:
                                 rindx = np.random.randint(npoints)
                                 if not np.all(x[rindx] == self.centroids).any():
                                     break
-                            self._add_point_to_cluster(x[rindx], rindx, oldcluster)
+                            self._add_point_to_cluster(rindx, oldcluster)
                             fromcluster = np.argwhere(self.membership[:, rindx])[0][0]
-                            self._remove_point_from_cluster(x[rindx], rindx, fromcluster)
+                            self._remove_point_from_cluster(rindx, fromcluster)
+                            labels[rindx] = np.argwhere(self.membership[:, rindx])[0][0]
+                            if start <= rindx < end:
+                                # it's in this block, so where it belongs has to be looked at again
+                                rest = slice(ipoint + 1 - start, end - start)
+                                tomove = (np.flatnonzero(nearest[rest] != labels[ipoint + 1:end]) + ipoint + 1).tolist()
 
             # all points seen in this iteration
             converged = (moves == 0)
             if verbose:
                 print("Iteration: {0}/{1}, moves: {2}".format(itr, max_iters, moves))
 
-        self.calculate_clustering_cost(x)
-        self.clusters = np.array([np.argwhere(self.membership[:, pt])[0] for pt in range(npoints)])
+        self.centroids[:] = self.decode(centroid_codes)
+        # calculate_clustering_cost, but from the codes, which are quicker to compare
+        self.cost = np.sum(codes != centroid_codes[labels])
+        self.clusters = labels[:, np.newaxis]
 
     def init_centroids(self, x):
         assert self.initMethod in ('Huang', 'Cao')
@@ -158,17 +254,14 @@ class KModes(object):
         if self.initMethod == 'Huang':
             # determine frequencies of attributes
             for iattr in range(nattrs):
-                freq = defaultdict(int)
-                for curattr in x[:, iattr]:
-                    freq[curattr] += 1
+                values, counts = np.unique(x[:, iattr], return_counts=True)
                 # sample centroids using the probabilities of attributes
                 # (I assume that's what's meant in the Huang [1998] paper; it works, at least)
-                # note: sampling using population in static list with as many choices as
-                # frequency counts this works well since (1) we re-use the list k times here,
-                # and (2) the counts are small integers so memory consumption is low
-                choices = [chc for chc, wght in freq.items() for _ in range(wght)]
-                for ik in range(self.k):
-                    self.centroids[ik, iattr] = random.choice(choices)
+                # note: sampling from a population with each value repeated as many times as
+                # its frequency count, the same way random.choice would
+                choices = np.repeat(values, counts)
+                picks = [int(random.random() * len(choices)) for _ in range(self.k)]
+                self.centroids[:, iattr] = choices[picks]
             # the previously chosen centroids could result in empty clusters,
             # so set centroid to closest point in x
             for ik in range(self.k):
@@ -183,11 +276,8 @@ class KModes(object):
             # determine densities points
             dens = np.zeros(npoints)
             for iattr in range(nattrs):
-                freq = defaultdict(int)
-                for val in x[:, iattr]:
-                    freq[val] += 1
-                for ipoint in range(npoints):
-                    dens[ipoint] += freq[x[ipoint, iattr]] / float(nattrs)
+                _, inverse, counts = np.unique(x[:, iattr], return_inverse=True, return_counts=True)
+                dens += counts[inverse] / float(nattrs)
             dens /= npoints
 
             # choose centroids based on distance and density
@@ -197,32 +287,73 @@ class KModes(object):
             # for the reamining centroids, choose max dens * dissim to the (already assigned)
             # centroid with the lowest dens * dissim
             for ik in range(2, self.k):
-                dd = np.empty((ik, npoints))
-                for ikk in range(ik):
-                    dd[ikk] = self.get_dissim(x, self.centroids[ikk]) * dens
+                dd = self.get_dissims(x, self.centroids[:ik]).T * dens
                 self.centroids[ik] = x[np.argmax(np.min(dd, axis=0))]
 
         return
 
-    def _add_point_to_cluster(self, point, ipoint, cluster):
+    def _move_batch(self, codes, labels, centroid_codes):
+        # move every point to its nearest centroid, then update the centroids of the clusters that
+        # changed; returns how many moved. A point stays put if its own centroid is as near as any,
+        # so points don't go back and forth between equally near ones. Empty clusters keep their
+        # centroids.
+        dissims = self.get_dissims(codes, centroid_codes)
+        nearest = np.argmin(dissims, axis=1)
+        ipoints = np.arange(len(codes))
+        stay = dissims[ipoints, labels] == dissims[ipoints, nearest]
+        nearest[stay] = labels[stay]
+        tomove = np.flatnonzero(nearest != labels)
+        if not len(tomove):
+            return 0
+        oldclusters, clusters = labels[tomove], nearest[tomove]
+        self.membership[oldclusters, tomove] = 0
+        self.membership[clusters, tomove] = 1
+        flatcodes = self._flatCodes[tomove]
+        np.add.at(self._clustAttrFreqFlat, (oldclusters[:, np.newaxis], flatcodes), -1)
+        np.add.at(self._clustAttrFreqFlat, (clusters[:, np.newaxis], flatcodes), 1)
+        labels[tomove] = clusters
+        changed = np.union1d(oldclusters, clusters)
+        changed = changed[self.membership[changed].any(axis=1)]
+        centroid_codes[changed] = self.get_modes(changed)
+        return len(tomove)
+
+    def _move_point(self, ipoint, oldcluster, cluster):
+        self.membership[cluster, ipoint] = 1
+        self.membership[oldcluster, ipoint] = 0
+        # update frequencies of attributes in both clusters
+        self._clustAttrFreqFlat[cluster][self._flatCodes[ipoint]] += 1
+        self._clustAttrFreqFlat[oldcluster][self._flatCodes[ipoint]] -= 1
+        return
+
+    def _add_point_to_cluster(self, ipoint, cluster):
         self.membership[cluster, ipoint] = 1
         # update frequencies of attributes in cluster
-        for iattr, curattr in enumerate(point):
-            self._clustAttrFreq[cluster][iattr][curattr] += 1
+        self._clustAttrFreqFlat[cluster][self._flatCodes[ipoint]] += 1
         return
 
-    def _remove_point_from_cluster(self, point, ipoint, cluster):
+    def _remove_point_from_cluster(self, ipoint, cluster):
         self.membership[cluster, ipoint] = 0
         # update frequencies of attributes in cluster
-        for iattr, curattr in enumerate(point):
-            self._clustAttrFreq[cluster][iattr][curattr] -= 1
+        self._clustAttrFreqFlat[cluster][self._flatCodes[ipoint]] -= 1
         return
 
+    def get_modes(self, clusters):
+        # codes of the most frequent value of each attribute in each of clusters; ties go to the lowest value
+        return np.argmax(self._clustAttrFreq[clusters], axis=2)
+
+    def decode(self, codes):
+        return self._values[np.arange(self._values.shape[0]), codes]
+
     @staticmethod
     def get_dissim(a, b):
         # simple matching dissimilarity
         return (a != b).sum(axis=1)
 
+    @staticmethod
+    def get_dissims(a, b):
+        # simple matching dissimilarity of each of a to each of b [len(a) * len(b)]
+        return (a[:, np.newaxis, :] != b[np.newaxis, :, :]).sum(axis=2)
+
     @staticmethod
     def get_mode(dic):
         # Fast method (supposedly) to get key for maximum value in dict.
@@ -233,13 +364,75 @@ class KModes(object):
         return k[v.index(max(v))]
 
     def calculate_clustering_cost(self, x):
-        self.cost = 0
-        for ipoint, curpoint in enumerate(x):
-            self.cost += np.sum(self.get_dissim(self.centroids, curpoint) *
-                                (self.membership[:, ipoint] ** self.alpha))
+        self.cost = np.sum(self.get_dissims(x, self.centroids) * (self.membership.T ** self.alpha))
         return
 
 
+def _seeded_run(args):
+    # one of KModes._cluster_seeded's runs; module-level so the process pool can pickle it
+    model, x, seed, run_args, run_kwargs = args
+    random.seed(seed)
+    np.random.seed(seed)
+    model._perform_clustering(x, *run_args, verbose=0, **run_kwargs)
+    return model
+
+
+def encode_categories(x):
+    """Number each attribute's values: returns codes [no. points * no. attributes] and values
+    [no. attributes * most values of any attribute], where values[iattr, codes[ipoint, iattr]] is
+    x[ipoint, iattr]. Each attribute's values are sorted, and padded out with the last one. Codes
+    are as small an int type as will do, since comparing them is most of the work.
+
+    """
+    npoints, nattrs = x.shape
+    uniques, inverses = zip(*[np.unique(x[:, iattr], return_inverse=True) for iattr in range(nattrs)])
+    nvalues = max(len(unique) for unique in uniques)
+    codes = np.empty((npoints, nattrs), dtype=np.min_scalar_type(nvalues))
+    values = np.empty((nattrs, nvalues), dtype=x.dtype)
+    for iattr, (unique, inverse) in enumerate(zip(uniques, inverses)):
+        codes[:, iattr] = inverse
+        values[iattr, :len(unique)] = unique
+        values[iattr, len(unique):] = unique[-1]
+    return codes, values
+
+
+def fuzzy_membership(dissim, alpha, threshold, squared=False):
+    """Memberships [k * no. points] from dissimilarities [k * no. points]. A point within
+    threshold of any centroid belongs to those fully and to the rest by threshold; the rest are
+    weighed by their (squared, if squared) dissimilarities.
+
+    """
+    close = dissim <= threshold
+    anyclose = close.any(axis=0)
+    # points that are close to a centroid get overwritten below; stand in 1s for their
+    # dissimilarities, so there's no dividing by 0
+    dissim = np.where(anyclose, 1., dissim)
+    if squared:
+        dissim **= 2
+    factor = 1. / (alpha - 1)
+    membership = np.empty(dissim.shape)
+    for ik in range(dissim.shape[0]):
+        membership[ik] = 1 / np.sum((dissim[ik] / dissim)**factor, axis=0)
+    membership[:, anyclose] = np.where(close[:, anyclose], 1, threshold)
+    return membership
+
+
+def membership_sums(weights, codes, nvalues):
+    """Sums of weights [k * no. points] over the points with each value of each attribute
+    [k * no. attributes * nvalues], where codes and nvalues are from encode_categories.
+
+    """
+    k, npoints = weights.shape
+    nattrs = codes.shape[1]
+    sums = np.empty((k, nattrs, nvalues))
+    # each cluster's points are counted in its own nvalues bins
+    offsets = (np.arange(k) * nvalues)[:, np.newaxis]
+    for iattr in range(nattrs):
+        sums[:, iattr, :] = np.bincount((offsets + codes[:, iattr]).ravel(), weights=weights.ravel(),
+                                        minlength=k * nvalues).reshape(k, nvalues)
+    return sums
+
+
 class KPrototypes(KModes):
 
     def __init__(self, k):
@@ -491,11 +684,12 @@ class FuzzyKModes(KModes):
             print("Init: initializing centroids")
         self.init_centroids(x)
 
-        # store for all attributes which points have a certain attribute value
-        self._domAttrPoints = [defaultdict(list) for _ in range(nattrs)]
-        for ipoint, curpoint in enumerate(x):
-            for iattr, curattr in enumerate(curpoint):
-                self._domAttrPoints[iattr][curattr].append(ipoint)
+        # the rest is done with each attribute's values numbered (see encode_categories), so the
+        # centroids are codes too
+        self._codes, self._values = encode_categories(x)
+        self._centroidCodes = np.empty((self.k, nattrs), dtype=self._codes.dtype)
+        for iattr in range(nattrs):
+            self._centroidCodes[:, iattr] = np.searchsorted(self._values[iattr], self.centroids[:, iattr])
 
         # ----------------------
         #    ITERATION
@@ -506,7 +700,7 @@ class FuzzyKModes(KModes):
         converged = False
         lastcost = np.inf
         while itr <= max_iters and not converged:
-            self.update_membership(x)
+            self.update_membership()
             self.update_centroids()
 
             # computationally expensive, only check every N steps
@@ -518,30 +712,23 @@ class FuzzyKModes(KModes):
                     print("Iteration: {0}/{1}, cost: {2}".format(itr, max_iters, self.cost))
             itr += 1
 
-        self.clusters = np.array([int(np.argmax(self.membership[:, pt])) for pt in range(npoints)])
+        self.clusters = np.argmax(self.membership, axis=0)
 
-    def update_membership(self, x, threshold=1e-3):
-        npoints = x.shape[0]
-        self.membership = np.empty((self.k, npoints))
-        for ipoint, curpoint in enumerate(x):
-            dissim = self.get_dissim(self.centroids, curpoint)
-            if np.any(dissim <= threshold):
-                self.membership[:, ipoint] = np.where(dissim <= threshold, 1, threshold)
-            else:
-                for ik in range(len(self.centroids)):
-                    factor = 1. / (self.alpha - 1)
-                    self.membership[ik, ipoint] = 1 / np.sum((float(dissim[ik]) / dissim)**factor)
+    def update_membership(self, threshold=1e-3):
+        dissim = self.get_dissims(self._codes, self._centroidCodes).T
+        self.membership = fuzzy_membership(dissim, self.alpha, threshold)
         return
 
     def update_centroids(self):
-        self.centroids = np.empty((self.k, len(self._domAttrPoints)))
-        for ik in range(self.k):
-            for iattr in range(len(self._domAttrPoints)):
-                # return attribute that maximizes the sum of the memberships
-                v = list(self._domAttrPoints[iattr].values())
-                k = list(self._domAttrPoints[iattr].keys())
-                memvar = [sum(self.membership[ik, x]**self.alpha) for x in v]
-                self.centroids[ik, iattr] = k[np.argmax(memvar)]
+        # return attribute that maximizes the sum of the memberships
+        memvar = membership_sums(self.membership ** self.alpha, self._codes, self._values.shape[1])
+        self._centroidCodes = np.argmax(memvar, axis=2)
+        self.centroids = self.decode(self._centroidCodes).astype(float)
+        return
+
+    def calculate_clustering_cost(self, x):
+        # from the codes, which are quicker to compare
+        self.cost = np.sum(self.get_dissims(self._codes, self._centroidCodes) * (self.membership.T ** self.alpha))
         return
 
 
@@ -592,21 +779,20 @@ class FuzzyCentroidsKModes(KModes):
         # ----------------------
         if verbose:
             print("Init: initializing centroids")
-        # count all attributes
-        freqattrs = [defaultdict(int) for _ in range(nattrs)]
-        for curpoint in x:
-            for iattr, curattr in enumerate(curpoint):
-                freqattrs[iattr][curattr] += 1
-
-        # omega = fuzzy set (as dict) for each attribute per cluster
-        self.omega = [[{} for _ in range(nattrs)] for _ in range(self.k)]
+        # the rest is done with each attribute's values numbered (see encode_categories)
+        self._codes, self._values = encode_categories(x)
+        nvalues = self._values.shape[1]
+        self._flatCodes = np.arange(nattrs) * nvalues + self._codes
+        nattrvalues = self._codes.max(axis=0) + 1
+
+        # omega = fuzzy set for each attribute per cluster, as self._omega[cluster, attribute, code]
+        # (and, once done, as dicts, see below)
+        self._omega = np.zeros((self.k, nattrs, nvalues))
         for ik in range(self.k):
             for iattr in range(nattrs):
                 # a bit unclear form the paper, but this is how they do it in their code
                 # give a random attribute 1.0 membership and the rest 0.0
-                randint = np.random.randint(len(freqattrs[iattr]))
-                for iVal, curVal in enumerate(freqattrs[iattr]):
-                    self.omega[ik][iattr][curVal] = float(iVal == randint)
+                self._omega[ik, iattr, np.random.randint(nattrvalues[iattr])] = 1.
 
         # ----------------------
         #    ITERATION
@@ -618,10 +804,10 @@ class FuzzyCentroidsKModes(KModes):
         lastcost = np.inf
         while itr <= max_iters and not converged:
             # O(k*N*at*no. of unique values)
-            self.update_membership(x)
+            self.update_membership()
 
             # O(k*N*at)
-            self.update_centroids(x)
+            self.update_centroids()
 
             # computationally expensive, only check every N steps
             if itr % cost_inter == 0:
@@ -632,56 +818,41 @@ class FuzzyCentroidsKModes(KModes):
                     print("Iteration: {0}/{1}, cost: {2}".format(itr, max_iters, self.cost))
             itr += 1
 
-        self.clusters = np.array([int(np.argmax(self.membership[:, pt])) for pt in range(npoints)])
+        self.omega = [[dict(zip(self._values[iattr, :nattrvalues[iattr]].tolist(),
+                                self._omega[ik, iattr, :nattrvalues[iattr]].tolist()))
+                       for iattr in range(nattrs)] for ik in range(self.k)]
+        self.clusters = np.argmax(self.membership, axis=0)
 
-    def update_membership(self, x, threshold=1e-3):
+    def update_membership(self, threshold=1e-3):
         # Eq. 20 from Kim et al. [2004]
-        npoints = x.shape[0]
-        self.membership = np.empty((self.k, npoints))
-        for ipoint, curpoint in enumerate(x):
-            dissim = self.get_fuzzy_dissim(curpoint)
-            if np.any(dissim <= threshold):
-                self.membership[:, ipoint] = np.where(dissim <= threshold, 1, threshold)
-            else:
-                # NOTE: squaring the distances is not mentioned in the paper, but it is
-                # in the code of Kim et al.; seems to improve performance
-                dissim **= 2
-                for ik in range(len(self.omega)):
-                    factor = 1. / (self.alpha - 1)
-                    self.membership[ik, ipoint] = 1 / np.sum((float(dissim[ik]) / dissim)**factor)
+        # NOTE: squaring the distances is not mentioned in the paper, but it is
+        # in the code of Kim et al.; seems to improve performance
+        self.membership = fuzzy_membership(self.get_fuzzy_dissim(), self.alpha, threshold, squared=True)
         return
 
-    def update_centroids(self, x):
-        self.omega = [[defaultdict(float) for _ in range(x.shape[1])] for _ in range(self.k)]
-        for ik in range(self.k):
-            for iattr in range(x.shape[1]):
-                for ipoint, curpoint in enumerate(x[:, iattr]):
-                    self.omega[ik][iattr][curpoint] += self.membership[ik, ipoint] ** self.alpha
-                # normalize so that sum omegas is 1, analogous to k-means
-                # (see e.g. Yang et al. [2008] who explain better than the original paper)
-                sumomg = sum(self.omega[ik][iattr].values())
-                for key in self.omega[ik][iattr].keys():
-                    self.omega[ik][iattr][key] /= sumomg
+    def update_centroids(self):
+        self._omega = membership_sums(self.membership ** self.alpha, self._codes, self._values.shape[1])
+        # normalize so that sum omegas is 1, analogous to k-means
+        # (see e.g. Yang et al. [2008] who explain better than the original paper)
+        self._omega /= np.sum(self._omega, axis=2)[:, :, np.newaxis]
         return
 
-    def get_fuzzy_dissim(self, x):
-        # TODO: slow, could it be faster?
-        # dissimilarity = sums of all omegas for non-matching attributes
+    def get_fuzzy_dissim(self):
+        # dissimilarity of each point to each cluster [k * no. points]
+        # = sums of all omegas for non-matching attributes
         # see Eqs. 13-15 of Kim et al. [2004]
-        dissim = np.zeros(len(self.omega))
-        for ik in range(len(self.omega)):
-            for iattr, curattr in enumerate(self.omega[ik]):
-                nonmatch = [v for k, v in curattr.items() if k != x[iattr]]
-                # dissim[ik] += sum(nonmatch)
-                # following the code of Kim et al., seems to work better
-                dissim[ik] += sum(nonmatch) / np.sqrt(np.sum(np.array(list(curattr.values())) ** 2))
+        # following the code of Kim et al., each attribute's is divided by the norm of its omegas,
+        # which seems to work better
+        sums = np.sum(self._omega, axis=2)
+        norms = np.sqrt(np.sum(self._omega ** 2, axis=2))
+        dissim = np.empty((self.k, self._codes.shape[0]))
+        for ik in range(self.k):
+            matching = self._omega[ik].ravel()[self._flatCodes]
+            dissim[ik] = np.sum((sums[ik] - matching) / norms[ik], axis=1)
         return dissim
 
     def calculate_clustering_cost(self, x):
-        self.cost = 0
-        for ipoint, curpoint in enumerate(x):
-            self.cost += np.sum(self.get_fuzzy_dissim(curpoint) *
-                                (self.membership[:, ipoint] ** self.alpha))
+        self.cost = np.sum(self.get_fuzzy_dissim() * (self.membership ** self.alpha))
         return
 
 
@@ -717,5 +888,23 @@ def soybean_test():
             print(" D{0} |    {1:>2} |    {2:>2} |    {3:>2} |    {4:>2} |".format(*prargs))
 
 
+def seeded_test():
+    # a seeded cluster() should come out the same however many processes it runs on
+    r = np.random.RandomState(0)
+    x = r.randint(5, size=(4, 12))[r.randint(4, size=200)]
+    noise = r.rand(*x.shape) < 0.3
+    x[noise] = r.randint(5, size=noise.sum())
+    for make, data in [(lambda: KModes(4), x), (lambda: KPrototypes(4), [r.randn(x.shape[0], 3), x]),
+                       (lambda: FuzzyKModes(4, alpha=1.1), x), (lambda: FuzzyCentroidsKModes(4, alpha=1.8), x)]:
+        results = []
+        for n_jobs in (1, 3):
+            model = make()
+            model.cluster(data, pre_runs=4, n_jobs=n_jobs, seed=7, verbose=0)
+            results.append((model.cost, model.clusters.ravel().tolist()))
+        assert results[0] == results[1], "{0} depends on n_jobs".format(type(model).__name__)
+        print("{0}: same cost ({1}) and clusters with 1 and 3 processes".format(type(model).__name__, results[0][0]))
+
+
 if __name__ == "__main__":
+    seeded_test()
     soybean_test()
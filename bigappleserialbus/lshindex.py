@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+__author__ = 'Jeremy B. Merrill'
+__email__ = 'jeremybmerrill@gmail.com'
+__license__ = 'Apache'
+__version__ = '0.1'
+
+import numpy as np
+
+default_tables = 8 # more tables, better recall, slower queries
+bucket_size = 4 # aim for about this many times k trajectories per bucket
+
+class RandomProjectionIndex:
+  """Approximate nearest neighbors by random-projection LSH, for when a time bucket has too many
+     trajectories for the exact ball tree to keep up on the Pi.
+
+     Each of `tables` hash tables splits the (centered) trajectories by which side of `bits` random
+     hyperplanes they fall on; a query's candidates are everything that shares a bucket with it in
+     any table, and only those get exact distances. More tables means more candidates: better
+     recall, slower queries. If there aren't even k candidates, it searches everything.
+
+     Fits and queries like sklearn's NearestNeighbors, so it can stand in for one. The hyperplanes
+     come from a fixed seed, so the same data always gets the same answers.
+  """
+  def __init__(self, n_neighbors=10, tables=default_tables, bits=None, seed=0):
+    self.n_neighbors = n_neighbors
+    self.tables = tables
+    self.bits = bits
+    self.seed = seed
+
+  def fit(self, X):
+    self.data = np.asarray(X, dtype=float)
+    n, dimensions = self.data.shape
+    bits = self.bits or max(1, int(np.log2(max(n, 1) / float(bucket_size * self.n_neighbors))))
+    self.center = self.data.mean(axis=0)
+    self.planes = np.random.RandomState(self.seed).randn(self.tables, bits, dimensions)
+    self.powers = 2 ** np.arange(bits)
+    codes = self.hash(self.data) # tables x n
+    self.buckets = []
+    for table_codes in codes:
+      order = np.argsort(table_codes, kind='mergesort')
+      boundaries = np.flatnonzero(np.diff(table_codes[order])) + 1
+      starts = np.concatenate([[0], boundaries])
+      self.buckets.append(dict(zip(table_codes[order][starts], np.split(order, boundaries))))
+    return self
+
+  def hash(self, X):
+    """Each row's bucket in each table, as a tables x rows array."""
+    sides = np.einsum('tbd,nd->tnb', self.planes, X - self.center) > 0
+    return sides.dot(self.powers)
+
+  def kneighbors(self, X):
+    X = np.atleast_2d(np.asarray(X, dtype=float))
+    k = min(self.n_neighbors, len(self.data))
+    codes = self.hash(X)
+    distances = np.empty((len(X), k))
+    indices = np.empty((len(X), k), dtype=int)
+    empty = np.empty(0, dtype=int)
+    for row, query in enumerate(X):
+      candidates = np.unique(np.concatenate([self.buckets[table].get(codes[table, row], empty) for table in xrange(self.tables)]))
+      if len(candidates) < k:
+        candidates = np.arange(len(self.data))
+      candidate_distances = np.sqrt(((self.data[candidates] - query) ** 2).sum(axis=1))
+      nearest = np.argsort(candidate_distances, kind='mergesort')[:k]
+      distances[row] = candidate_distances[nearest]
+      indices[row] = candidates[nearest]
+    return (distances, indices)
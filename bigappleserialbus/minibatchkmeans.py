@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+__author__ = 'Jeremy B. Merrill'
+__email__ = 'jeremybmerrill@gmail.com'
+__license__ = 'Apache'
+__version__ = '0.1'
+
+import numpy as np
+
+default_epochs = 10
+default_batch_size = 100
+
+class MiniBatchKMeans:
+  """k-means that learns a mini-batch at a time (Sculley, "Web-Scale K-Means Clustering", 2010), so it
+     can keep learning as trajectories come in instead of starting over.
+
+     Each centroid is the running mean of the points assigned to it, i.e. it moves 1/count of the way
+     to each new one. Past `memory` points, it stops slowing down, and keeps moving 1/memory of the way,
+     so clusters follow the buses when the schedule changes.
+
+     The initial centroids are k distinct points picked with a fixed seed, so the same data always
+     makes the same clusters.
+  """
+  def __init__(self, n_clusters, memory=None, seed=0, centroids=None, counts=None):
+    self.n_clusters = n_clusters
+    self.memory = memory
+    self.seed = seed
+    self.centroids = None if centroids is None else np.asarray(centroids, dtype=float)
+    self.counts = None if counts is None else np.asarray(counts, dtype=float)
+
+  def fit(self, X, epochs=default_epochs, batch_size=default_batch_size):
+    """Start over: pick initial centroids from X, then make `epochs` shuffled passes over it."""
+    X = np.asarray(X, dtype=float)
+    random = np.random.RandomState(self.seed)
+    k = min(self.n_clusters, len(X))
+    self.centroids = X[random.choice(len(X), k, replace=False)].copy()
+    self.counts = np.zeros(k)
+    for epoch in xrange(epochs):
+      order = random.permutation(len(X))
+      for start in xrange(0, len(X), batch_size):
+        self.partial_fit(X[order[start:start + batch_size]])
+    return self
+
+  def partial_fit(self, X):
+    """Move the centroids toward a mini-batch of new points."""
+    X = np.asarray(X, dtype=float)
+    labels = self.predict(X)
+    k = len(self.centroids)
+    batch_counts = np.bincount(labels, minlength=k).astype(float)
+    batch_sums = np.zeros_like(self.centroids)
+    np.add.at(batch_sums, labels, X)
+    counts = self.counts if self.memory is None else np.minimum(self.counts, self.memory)
+    moved = batch_counts > 0
+    self.centroids[moved] = (self.centroids[moved] * counts[moved, None] + batch_sums[moved]) / (counts[moved] + batch_counts[moved])[:, None]
+    self.counts += batch_counts
+    return self
+
+  def distances(self, X):
+    """Squared distance from each row of X to each centroid, as a rows x centroids array."""
+    X = np.atleast_2d(np.asarray(X, dtype=float))
+    return (X ** 2).sum(axis=1)[:, None] - 2 * X.dot(self.centroids.T) + (self.centroids ** 2).sum(axis=1)[None, :]
+
+  def predict(self, X):
+    """Each row's nearest centroid."""
+    return self.distances(X).argmin(axis=1)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+__author__ = 'Jeremy B. Merrill'
+__email__ = 'jeremybmerrill@gmail.com'
+__license__ = 'Apache'
+__version__ = '0.1'
+
+import time
+import heapq
+from math import sqrt
+import capturelog
+import siri
+import trajectorystore
+
+import logging #magically the same as the one in bigappleserialbus.py
+
+class VirtualClock:
+  """Stands in for time.time() during a replay: it's always the time of the response being replayed."""
+  def __init__(self, now=0):
+    self.now = now
+
+  def time(self):
+    return self.now
+
+  def advance_to(self, seconds):
+    self.now = max(self.now, seconds)
+
+class Replay:
+  """Replays captured BusTime responses through BusStop.check, as fast as they can be processed.
+
+     Every stop's captures are merged into one timeline, so the stops see the day in the same
+     order they did live, and the same captures always give the same results. Nothing sleeps or
+     touches the network; the virtual clock moves to each response's time as it's replayed.
+
+     With follow_schedule, responses that came in before a stop's next_check_at (by the virtual
+     clock) are skipped, to see what BusStop.seconds_until_next_check would have fetched; otherwise
+     every response is checked.
+
+     Like replaying debugjson always did, it doesn't save the trajectories it sees by default, so
+     later predictions in a replay don't learn from earlier buses, a replay never writes to the db,
+     and replaying the same captures twice gives the same predictions. With save_trajectories, they
+     go into the session and the stores as they finish, like they do live.
+  """
+  def __init__(self, bus_stops, session, reader=None, since=None, until=None, follow_schedule=False, save_trajectories=False):
+    self.bus_stops = bus_stops
+    self.session = session
+    self.reader = reader or capturelog.CaptureReader()
+    self.since = since
+    self.until = until
+    self.follow_schedule = follow_schedule
+    self.save_trajectories = save_trajectories
+    self.clock = VirtualClock()
+    self.checked = 0
+    self.skipped = 0
+
+  def captures(self):
+    """Yields (stop, Capture) for each response for one of our stops, in time order across all of them."""
+    stops_by_key = dict([((stop.route_name, stop.stop_id), stop) for stop in self.bus_stops])
+    route_names = sorted(set([route_name for route_name, _ in stops_by_key.keys()]))
+    timelines = [self.route_timeline(order, route_name, stops_by_key) for order, route_name in enumerate(route_names)]
+    for _, _, _, stop, capture in heapq.merge(*timelines):
+      yield (stop, capture)
+
+  def route_timeline(self, order, route_name, stops_by_key):
+    # one pass over each route's segments serves all of its stops; (order, count) breaks ties between
+    # responses from the same moment the same way every time, and keeps heapq from comparing stops.
+    for count, capture in enumerate(self.reader.read(route_name, since=self.since, until=self.until)):
+      stop = stops_by_key.get((route_name, capture.stop_id))
+      if stop:
+        yield (capture.seconds, order, count, stop, capture)
+
+  def run(self, on_check=None):
+    """Replay every capture, calling on_check(stop) after each check. Returns the report()."""
+    started = time.time()
+    for stop, capture in self.captures():
+      self.clock.advance_to(capture.seconds)
+      if self.follow_schedule and stop.next_check_at > self.clock.time():
+        self.skipped += 1
+        continue
+      logging.debug("checking %(route_name)s/%(end_stop_id)s (%(count)i buses on route)" %
+        {'route_name': stop.route_name, 'count': len(stop.buses_on_route), 'end_stop_id': stop.stop_id })
+      check_timestamp, visits = siri.read_stop_monitoring(capture.body)
+      trajectories = stop.check((visits, check_timestamp, True))
+      self.checked += 1
+      for traj in [traj for traj in trajectories if traj]:
+        logging.debug("writing trajectory:" + str(traj))
+        if self.save_trajectories:
+          self.session.add(traj)
+          trajectorystore.store_for(traj.route_name, traj.end_stop_id, self.session).append(traj)
+      if on_check:
+        on_check(stop)
+      if self.follow_schedule:
+        stop.schedule_next_check(self.clock.time())
+    self.session.commit()
+    duration = time.time() - started
+    logging.debug("replayed %(checked)i responses (skipped %(skipped)i) in %(sec).1fs, %(rate).1f/s" %
+      {'checked': self.checked, 'skipped': self.skipped, 'sec': duration, 'rate': self.checked / max(duration, 0.001)})
+    return self.report()
+
+  def report(self):
+    """Returns (route_name, stop_id, count, rmse) of the arrival-time errors for each stop, and prints them."""
+    report = []
+    for stop in self.bus_stops:
+      errors = stop.session_errors
+      rmse = sqrt(sum([error ** 2 for error in errors]) / float(len(errors))) if errors else None
+      report.append((stop.route_name, stop.stop_id, len(errors), rmse))
+      print("%(route_name)s/%(stop_id)s: %(count)i buses, rmse %(rmse)s" %
+        {'route_name': stop.route_name, 'stop_id': stop.stop_id, 'count': len(errors), 'rmse': "%.1fs" % rmse if rmse is not None else "n/a"})
+    return report
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+
+__author__ = 'Jeremy B. Merrill'
+__email__ = 'jeremybmerrill@gmail.com'
+__license__ = 'Apache'
+__version__ = '0.1'
+
+import random
+
+import logging #magically the same as the one in bigappleserialbus.py
+
+base_retry_delay = 5 #seconds
+max_retry_delay = 240 #seconds
+
+class RetryQueue:
+  """Keeps track of fetchers whose last request failed and when they should next be retried.
+
+     Delays back off exponentially with consecutive failures, with jitter so that routes that
+     failed together (e.g. when the WiFi dropped) don't all retry in lockstep.
+  """
+  def __init__(self, base_delay=base_retry_delay, max_delay=max_retry_delay):
+    self.base_delay = base_delay
+    self.max_delay = max_delay
+    self.failures = {} # fetcher -> consecutive failures
+    self.retry_at = {} # fetcher -> time.time() after which to retry; absent while a retry is in flight
+
+  def failed(self, fetcher, now):
+    self.failures[fetcher] = self.failures.get(fetcher, 0) + 1
+    delay = min(self.max_delay, self.base_delay * (2 ** (self.failures[fetcher] - 1)))
+    delay = (delay / 2.0) + random.uniform(0, delay / 2.0)
+    self.retry_at[fetcher] = now + delay
+    logging.debug("%(fetcher)s failed %(count)i time(s) in a row, retrying in %(delay)is" %
+      {'fetcher': fetcher, 'count': self.failures[fetcher], 'delay': delay})
+
+  def succeeded(self, fetcher):
+    self.failures.pop(fetcher, None)
+    self.retry_at.pop(fetcher, None)
+
+  def is_waiting(self, fetcher):
+    """True from when the fetcher fails until a retry of it succeeds."""
+    return fetcher in self.failures
+
+  def due(self, now):
+    """Returns the fetchers whose backoff is up, and takes them off the clock until they fail or succeed again."""
+    due_fetchers = [fetcher for fetcher, retry_at in self.retry_at.items() if retry_at <= now]
+    for fetcher in due_fetchers:
+      del self.retry_at[fetcher]
+    return due_fetchers
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+__author__ = 'Jeremy B. Merrill'
+__email__ = 'jeremybmerrill@gmail.com'
+__license__ = 'Apache'
+__version__ = '0.1'
+
+from busstop import write_bustime_responses_for_debug, mta_api_key
+import bustime
+import siri
+
+import logging #magically the same as the one in bigappleserialbus.py
+
+class RouteFetcher:
+  """Gets BusTime data for every configured stop on one route with a single request.
+
+     Rather than one stop-monitoring request per stop, this makes one VehicleMonitoring
+     request per line (LineRef) and hands each BusStop the vehicles that are headed to it,
+     as siri.Visits just like the ones from that stop's own stop-monitoring response.
+  """
+  mta_key = mta_api_key
+
+  def __init__(self, route_name, stops):
+    self.route_name = route_name
+    self.lineRef = "MTA NYCT_" + route_name.upper()
+    self.stops = stops
+
+  def next_check_at(self):
+    """One request serves every stop on the route, so it's due as soon as any of them is."""
+    return min([stop.next_check_at for stop in self.stops]) if self.stops else 0
+
+  def __repr__(self):
+    return "<RouteFetcher %(route)s (%(count)i stops)>" % {'route': self.route_name, 'count': len(self.stops)}
+
+  def get_locations(self):
+    """Returns a (stop, locations) pair for each stop, where locations is what BusStop.get_locations would return."""
+    requestPath = "/api/siri/vehicle-monitoring.json?key=%(key)s&OperatorRef=MTA&LineRef=%(line)s&VehicleMonitoringDetailLevel=%(onw)s" %\
+            {'key': self.mta_key, 'line': self.lineRef.replace(' ', '%20'), 'onw': 'calls'}
+    jsonresp = bustime.get(requestPath)
+    if jsonresp is None:
+      return [(stop, (None, None, False)) for stop in self.stops]
+    try:
+      check_timestamp, vehicle_activities = siri.read_vehicle_monitoring(jsonresp)
+    except ValueError as e:
+      logging.debug("bad BusTime response: " + str(e))
+      return [(stop, (None, None, False)) for stop in self.stops]
+
+    visits_by_stop = self.split_by_stop(vehicle_activities)
+    stop_locations = []
+    for stop in self.stops:
+      if write_bustime_responses_for_debug:
+        stop.capture_response(siri.to_stop_monitoring_json(visits_by_stop[stop.stop_id], check_timestamp), check_timestamp)
+      stop_locations.append((stop, (visits_by_stop[stop.stop_id], check_timestamp, True)))
+    return stop_locations
+
+  def split_by_stop(self, vehicle_activities):
+    """Fan the route's vehicles out to the stops they're headed to.
+
+       In a VehicleMonitoring response, a journey's MonitoredCall is just the vehicle's next stop;
+       a stop-monitoring response's MonitoredCall is the stop that was asked about. So for each of
+       our stops still ahead of a vehicle, swap in that stop's OnwardCall as the monitored call.
+       Vehicles going the other way never have our stop in their OnwardCalls, so they're dropped,
+       just like stop-monitoring would.
+    """
+    visits_by_stop = dict([(stop.stop_id, []) for stop in self.stops])
+    for activity in vehicle_activities:
+      for stop_id, visits in visits_by_stop.items():
+        visit = siri.for_stop(activity, stop_id)
+        if visit:
+          visits.append(visit)
+    return visits_by_stop
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+__author__ = 'Jeremy B. Merrill'
+__email__ = 'jeremybmerrill@gmail.com'
+__license__ = 'Apache'
+__version__ = '0.1'
+
+from collections import namedtuple
+from StringIO import StringIO
+import json
+
+# Both of these are optional. With ijson on one of its yajl backends, and stream_responses on, a
+# response is decoded one vehicle at a time, so we never hold the whole decoded response (every
+# OnwardCall of every bus on a route) in memory at once. That's the thing to do if memory on the Pi
+# gets tight, but on python 2 it's slower than decoding the whole thing with json.loads (ijson's
+# numbers come back as Decimals), so it's off by default. Otherwise the whole response is decoded
+# at once, by ujson if it's there, and boiled down to Visits right away.
+ijson = None
+for ijson_backend in ('yajl2_c', 'yajl2_cffi', 'yajl2'):
+  try:
+    ijson = __import__('ijson.backends.' + ijson_backend, fromlist=['items'])
+    from ijson.common import JSONError
+    break
+  except ImportError:
+    pass
+try:
+  import ujson as json_backend
+except ImportError:
+  json_backend = json
+stream_responses = False
+
+stop_monitoring_visits = 'Siri.ServiceDelivery.StopMonitoringDelivery.item.MonitoredStopVisit.item'
+vehicle_monitoring_activities = 'Siri.ServiceDelivery.VehicleMonitoringDelivery.item.VehicleActivity.item'
+response_timestamp = 'Siri.ServiceDelivery.ResponseTimestamp'
+
+# Just the parts of a SIRI response that Bus and BusStop use.
+# A Visit is one vehicle on its way to one stop: the stop's MonitoredStopVisit in a stop-monitoring
+# response, or a VehicleActivity (with monitored_call set to that stop) in a vehicle-monitoring one.
+# onward_calls only goes as far as the monitored call; nothing reads the calls after it.
+Call = namedtuple('Call', ['stop_ref', 'stop_name', 'distance_along_route', 'distance_from_call', 'presentable_distance'])
+Visit = namedtuple('Visit', ['vehicle_ref', 'recorded_at', 'monitored_call', 'onward_calls'])
+
+def read_stop_monitoring(body):
+  """Returns the response timestamp and a Visit per MonitoredStopVisit in a stop-monitoring response."""
+  return extract(body, stop_monitoring_visits, to_visit)
+
+def read_vehicle_monitoring(body):
+  """Returns the response timestamp and a Visit per VehicleActivity in a vehicle-monitoring response.
+
+     These Visits have every OnwardCall, and their monitored_call is just the vehicle's next stop;
+     RouteFetcher.split_by_stop narrows them down to each of our stops with for_stop.
+  """
+  return extract(body, vehicle_monitoring_activities, lambda activity: to_visit(activity, truncate=False))
+
+def extract(body, items_prefix, convert):
+  """Returns the ResponseTimestamp and convert(item) for each of the dicts at items_prefix in the JSON body.
+
+     Raises ValueError if the body isn't a SIRI response.
+  """
+  if stream_responses and ijson is not None:
+    try:
+      # the timestamp comes first, so this stops parsing almost right away.
+      check_timestamp = next(ijson.items(StringIO(body), response_timestamp), None)
+      if check_timestamp is None:
+        raise ValueError("Not a SIRI response: " + body[:200])
+      return (check_timestamp, [convert(item) for item in ijson.items(StringIO(body), items_prefix)])
+    except JSONError as e:
+      raise ValueError(str(e))
+    except (KeyError, IndexError, TypeError, AttributeError):
+      # same as below: an item convert can't make sense of means it isn't a SIRI response after all
+      raise ValueError("Not a SIRI response: " + body[:200])
+
+  resp = json_backend.loads(body)
+  try:
+    delivery_name, _, items_name, _ = items_prefix.split('.')[2:]
+    items = resp["Siri"]["ServiceDelivery"][delivery_name][0].get(items_name, [])
+    return (resp["Siri"]["ServiceDelivery"]["ResponseTimestamp"], [convert(item) for item in items])
+  except (KeyError, IndexError, TypeError, AttributeError):
+    raise ValueError("Not a SIRI response: " + body[:200])
+
+def to_visit(activity, truncate=True):
+  """Boil a MonitoredStopVisit/VehicleActivity dict down to a Visit."""
+  journey = activity["MonitoredVehicleJourney"]
+  monitored_call = to_call(journey["MonitoredCall"]) if "MonitoredCall" in journey else None
+  onward_calls = []
+  for onward_call in journey.get("OnwardCalls", {}).get("OnwardCall", []):
+    onward_calls.append(to_call(onward_call))
+    if truncate and monitored_call and onward_calls[-1].stop_ref == monitored_call.stop_ref:
+      break
+  return Visit(journey["VehicleRef"], activity["RecordedAtTime"], monitored_call, tuple(onward_calls))
+
+def to_call(call):
+  distances = call["Extensions"]["Distances"]
+  # ijson hands back Decimals
+  return Call(call["StopPointRef"], call.get("StopPointName"), float(distances["CallDistanceAlongRoute"]),
+              float(distances["DistanceFromCall"]), distances.get("PresentableDistance"))
+
+def for_stop(visit, stop_ref):
+  """The same vehicle, seen from stop_ref: monitored_call is stop_ref's call. None if the vehicle isn't headed there."""
+  for index, onward_call in enumerate(visit.onward_calls):
+    # loop routes can visit a stop twice; the first visit is the one coming up.
+    if onward_call.stop_ref == stop_ref:
+      return Visit(visit.vehicle_ref, visit.recorded_at, onward_call, visit.onward_calls[:index+1])
+  return None
+
+def to_stop_monitoring_json(visits, check_timestamp):
+  """Write Visits back out as (a bare-bones) stop-monitoring response, e.g. for BusStop.capture_response."""
+  return json.dumps({"Siri": {"ServiceDelivery": {
+            "ResponseTimestamp": check_timestamp,
+            "StopMonitoringDelivery": [{"MonitoredStopVisit": [
+              {"RecordedAtTime": visit.recorded_at, "MonitoredVehicleJourney": from_visit(visit)}
+              for visit in visits]}]
+          }}})
+
+def to_vehicle_monitoring_json(visits, check_timestamp):
+  """Write Visits back out as (a bare-bones) vehicle-monitoring response, e.g. for standin.py."""
+  return json.dumps({"Siri": {"ServiceDelivery": {
+            "ResponseTimestamp": check_timestamp,
+            "VehicleMonitoringDelivery": [{"VehicleActivity": [
+              {"RecordedAtTime": visit.recorded_at, "MonitoredVehicleJourney": from_visit(visit)}
+              for visit in visits]}]
+          }}})
+
+def from_visit(visit):
+  return {"VehicleRef": visit.vehicle_ref, "MonitoredCall": from_call(visit.monitored_call),
+          "OnwardCalls": {"OnwardCall": [from_call(call) for call in visit.onward_calls]}}
+
+def from_call(call):
+  return {"StopPointRef": call.stop_ref, "StopPointName": call.stop_name,
+          "Extensions": {"Distances": {"CallDistanceAlongRoute": call.distance_along_route,
+            "DistanceFromCall": call.distance_from_call, "PresentableDistance": call.presentable_distance}}}
@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+
+__author__ = 'Jeremy B. Merrill'
+__email__ = 'jeremybmerrill@gmail.com'
+__license__ = 'Apache'
+__version__ = '0.1'
+
+# A stand-in for the BusTime API, for load testing, plus a load driver to point at it.
+#
+#   python standin.py serve --port 8000 --latency 0.3 --error-rate 0.05 --vehicles 20
+#   python standin.py load --host localhost:8000 --stops 10,20,40,80,160 --ticks 4
+#
+# The load driver polls the way the app does, through BigAppleSerialBus.check_buses (a vehicle-monitoring
+# request per route, with failed routes retried by the RetryQueue); --per-stop polls stop by stop instead.
+#
+# The server answers stop-monitoring.json (what BusStop.get_locations asks for) and
+# vehicle-monitoring.json (what RouteFetcher asks for) from the responses in the capture log,
+# stepping through each stop's captures one request at a time and starting over at the end.
+
+import os
+import time
+import zlib
+import shutil
+import random
+import socket
+import struct
+import argparse
+import tempfile
+import urlparse
+import BaseHTTPServer
+import SocketServer
+from threading import Lock
+from itertools import cycle, islice, izip
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+import capturelog
+import siri
+
+import logging #magically the same as the one in bigappleserialbus.py
+
+failure_kinds = ['drop', 'reset', 'status', 'garbage']
+
+class StandInData:
+  """Each captured stop's responses, as siri.Visits, and which one to serve next."""
+  def __init__(self, reader=None, vehicles=None, since=None, until=None):
+    reader = reader or capturelog.CaptureReader()
+    self.vehicles = vehicles
+    self.frames = {} # stop_id -> [(check_timestamp, visits)]
+    self.stops_by_route = {} # route_name -> [stop_id]
+    for route_name, _ in reader.segments():
+      if route_name in self.stops_by_route:
+        continue # read() already went through all of this route's days
+      self.stops_by_route[route_name] = []
+      for capture in reader.read(route_name, since=since, until=until):
+        try:
+          check_timestamp, visits = siri.read_stop_monitoring(capture.body)
+        except ValueError:
+          continue
+        if capture.stop_id not in self.frames:
+          self.frames[capture.stop_id] = []
+          self.stops_by_route[route_name].append(capture.stop_id)
+        self.frames[capture.stop_id].append((check_timestamp, visits))
+    # every vehicle ever seen at each stop, for padding out responses to the synthetic vehicle count
+    self.all_visits = dict([(stop_id, [visit for _, visits in frames for visit in visits]) for stop_id, frames in self.frames.items()])
+    self.cursors = dict([(stop_id, 0) for stop_id in self.frames])
+    self.lock = Lock()
+
+  def captured_stops(self):
+    """(route_name, stop_id) for each stop there are captures of."""
+    return [(route_name, stop_id) for route_name in sorted(self.stops_by_route) for stop_id in self.stops_by_route[route_name]]
+
+  def next_frame(self, stop_id):
+    with self.lock:
+      frames = self.frames[stop_id]
+      check_timestamp, visits = frames[self.cursors[stop_id] % len(frames)]
+      self.cursors[stop_id] += 1
+    return (check_timestamp, self.pad(visits, self.all_visits[stop_id]))
+
+  def pad(self, visits, spare_visits):
+    """Exactly self.vehicles visits (if it's set), cloning real ones under made-up VehicleRefs as needed."""
+    if self.vehicles is None:
+      return visits
+    if len(visits) >= self.vehicles or not (visits or spare_visits):
+      return visits[:self.vehicles]
+    clones = islice(cycle(visits or spare_visits), self.vehicles - len(visits))
+    return visits + [clone._replace(vehicle_ref=clone.vehicle_ref + "_" + str(index)) for index, clone in enumerate(clones)]
+
+  def stop_monitoring(self, stop_id):
+    if stop_id not in self.frames:
+      return None
+    check_timestamp, visits = self.next_frame(stop_id)
+    return siri.to_stop_monitoring_json(visits, check_timestamp)
+
+  def vehicle_monitoring(self, line_ref):
+    """Put a route's stop-monitoring captures back together into a vehicle-monitoring response.
+
+       Each stop's MonitoredStopVisits only have the OnwardCalls up to that stop, so for each
+       vehicle, keep whichever visit goes farthest along the route.
+    """
+    stop_ids = self.stops_by_route.get(line_ref.split('_')[-1].lower())
+    if not stop_ids:
+      return None
+    farthest = {}
+    check_timestamp = None
+    for stop_id in stop_ids:
+      check_timestamp, visits = self.next_frame(stop_id)
+      for visit in visits:
+        if visit.vehicle_ref not in farthest or len(visit.onward_calls) > len(farthest[visit.vehicle_ref].onward_calls):
+          farthest[visit.vehicle_ref] = visit
+    return siri.to_vehicle_monitoring_json(sorted(farthest.values()), check_timestamp)
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+  def __init__(self, address, data, latency=0.0, jitter=0.0, error_rate=0.0):
+    BaseHTTPServer.HTTPServer.__init__(self, address, StandInHandler)
+    self.data = data
+    self.latency = latency
+    self.jitter = jitter
+    self.error_rate = error_rate
+
+  def delay(self):
+    return max(0.0, random.uniform(self.latency - self.jitter, self.latency + self.jitter))
+
+  def failure(self):
+    """None, or how to fail this request (one of failure_kinds), error_rate of the time."""
+    return random.choice(failure_kinds) if random.random() < self.error_rate else None
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1" # keep-alive, like BusTime
+
+  def do_GET(self):
+    url = urlparse.urlparse(self.path)
+    query = dict([(key, values[0]) for key, values in urlparse.parse_qs(url.query).items()])
+    time.sleep(self.server.delay())
+
+    failure = self.server.failure()
+    if failure == 'drop':
+      # hang up without answering; httplib raises BadStatusLine
+      self.close_connection = 1
+      return
+    if failure == 'reset':
+      # RST instead of FIN; the client gets a socket error
+      self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+      self.close_connection = 1
+      return
+    if failure == 'status':
+      return self.respond(503, "Service Unavailable")
+    if failure == 'garbage':
+      return self.respond(200, "<html>this isn't JSON</html>")
+
+    if url.path.endswith("/stop-monitoring.json"):
+      body = self.server.data.stop_monitoring(query.get("MonitoringRef"))
+    elif url.path.endswith("/vehicle-monitoring.json"):
+      body = self.server.data.vehicle_monitoring(query.get("LineRef", ""))
+    else:
+      body = None
+    if body is None:
+      return self.respond(404, "not found")
+    self.respond(200, body)
+
+  def respond(self, status, body):
+    if 'gzip' in self.headers.get('Accept-Encoding', ''):
+      compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+      body = compressor.compress(body) + compressor.flush()
+      gzipped = True
+    else:
+      gzipped = False
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    if gzipped:
+      self.send_header("Content-Encoding", "gzip")
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass # one line per request drowns out everything else
+
+def serve(port, data, latency=0.0, jitter=0.0, error_rate=0.0):
+  server = StandInServer(('', port), data, latency, jitter, error_rate)
+  logging.info("serving %(count)i stops' captures on port %(port)i" % {'count': len(data.frames), 'port': port})
+  server.serve_forever()
+
+def drive(host, captured_stops, stop_counts, ticks=4, workers=4, tick_seconds=15, stop_seconds_away=300, by_route=True):
+  """Poll and check stop_counts[0] stops for a few ticks, then stop_counts[1], etc, against the stand-in at host.
+
+     Stops beyond the captured ones are repeats of them. By default, each tick is BigAppleSerialBus's:
+     check_buses fetches one vehicle-monitoring response per route (see RouteFetcher) on a pool
+     with a worker per route, and retry_failed_fetches retries the routes that failed (see RetryQueue).
+     Each repeat of the captured stops gets its own RouteFetchers, as if it were more routes, and
+     every route is due every tick; failed routes are retried within the tick (see load_test_bus). With by_route False, each stop fetches its own stop-monitoring
+     response instead, on a pool of `workers` threads. Either way the stops are checked on this thread.
+     Stops once a tick takes longer than tick_seconds, and returns a row per stop count:
+     (stops, vehicles per tick, mean tick seconds, slowest tick seconds, failed fetches).
+  """
+  # these need the db and the API key, so only import them if we're driving.
+  import bustime
+  from busstop import BusStop
+  from routefetcher import RouteFetcher
+  from trajectory import Base, migrate
+  from sqlalchemy import create_engine
+  from sqlalchemy.orm import sessionmaker
+
+  # on a copy of buses.db, so nothing a load test does (migrating it, or saving what it checks) touches the real one
+  sqlite_db_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "../buses.db")
+  scratch_db = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+  scratch_db.close()
+  shutil.copy(sqlite_db_path, scratch_db.name)
+  engine = create_engine('sqlite:///' + scratch_db.name)
+  Base.metadata.create_all(engine)
+  session = sessionmaker(bind=engine)()
+  migrate(engine, session)
+  pool = None if by_route else ThreadPool(workers)
+
+  try:
+    results = []
+    for stop_count in stop_counts:
+      stops = []
+      route_fetchers = OrderedDict() # (repeat, route_name) -> that repeat's stops on the route
+      for index, (route_name, stop_id) in enumerate(islice(cycle(captured_stops), stop_count)):
+        stop = BusStop(route_name, stop_id)
+        stop.add_attributes(stop_seconds_away, session)
+        stops.append(stop)
+        route_fetchers.setdefault((index / len(captured_stops), route_name), []).append(stop)
+      if by_route:
+        route_fetchers = [RouteFetcher(route_name, route_stops) for (_, route_name), route_stops in route_fetchers.items()]
+        bustime.client = bustime.BusTimeClient(host, max_idle=len(route_fetchers))
+        polling = load_test_bus(route_fetchers, session)
+      else:
+        bustime.client = bustime.BusTimeClient(host, max_idle=workers)
+
+      durations = []
+      vehicles = 0
+      failures = 0
+      for tick in xrange(ticks):
+        start = time.time()
+        if by_route:
+          tick_vehicles, tick_failures = polling.tick()
+        else:
+          tick_vehicles, tick_failures = check_each_stop(pool, stops)
+        vehicles += tick_vehicles
+        failures += tick_failures
+        durations.append(time.time() - start)
+      if by_route:
+        polling.fetch_pool.close()
+
+      results.append((stop_count, vehicles / ticks, sum(durations) / ticks, max(durations), failures))
+      logging.info("%(stops)i stops, %(vehicles)i vehicles/tick: %(mean).2fs/tick (slowest %(max).2fs), %(failures)i failed fetches" %
+        {'stops': stop_count, 'vehicles': vehicles / ticks, 'mean': sum(durations) / ticks, 'max': max(durations), 'failures': failures})
+      if max(durations) > tick_seconds:
+        break
+    return results
+  finally:
+    if pool:
+      pool.close()
+    session.close()
+    os.remove(scratch_db.name)
+
+def check_each_stop(pool, stops):
+  """One tick of polling stop by stop: fetch every stop's stop-monitoring response on the pool, then check them. Returns (vehicles, failed fetches)."""
+  vehicles = 0
+  failures = 0
+  for stop, locations in izip(stops, pool.map(get_locations, stops)):
+    stop.check(locations)
+    if stop.status_error:
+      failures += 1
+    else:
+      vehicles += len(locations[0])
+  return (vehicles, failures)
+
+def get_locations(stop):
+  return stop.get_locations()
+
+def load_test_bus(route_fetchers, session, retries_per_tick=2):
+  """A BigAppleSerialBus that polls route_fetchers, minus the config, the lights and the ticker.
+
+     Its check_buses, retry_failed_fetches and check_stops are the app's own, so the load test runs
+     what runs live. Its RetryQueue doesn't back off, though, and each tick waits for up to
+     retries_per_tick rounds of retries, so a tick's time includes retrying the routes that failed.
+  """
+  from bigappleserialbus import BigAppleSerialBus # it's the app, so only import it if we're driving by route.
+  from retryqueue import RetryQueue
+
+  class LoadTestBus(BigAppleSerialBus):
+    def __init__(self):
+      self.session = session
+      self.route_fetchers = route_fetchers
+      self.bus_stops = [stop for route_fetcher in route_fetchers for stop in route_fetcher.stops]
+      self.__init_fetch_pool__()
+      self.retry_queue = RetryQueue(base_delay=0, max_delay=0)
+      self.vehicles = 0
+      self.failures = 0
+
+    def tick(self):
+      """One of the app's ticks, with every route due. Returns the (vehicles, failed fetches) it checked."""
+      self.vehicles = 0
+      self.failures = 0
+      for stop in self.bus_stops:
+        stop.next_check_at = 0
+      self.check_buses()
+      for retry in xrange(retries_per_tick):
+        if not self.retry_queue.failures:
+          break
+        self.retry_failed_fetches() # starts retrying every route that's failed...
+        while self.finished_retries.qsize() < len(self.retry_queue.failures):
+          time.sleep(0.01)
+        self.retry_failed_fetches() # ...and checks their stops once they've all come back.
+      return (self.vehicles, self.failures)
+
+    def check_stops(self, route_fetcher, stop_locations):
+      BigAppleSerialBus.check_stops(self, route_fetcher, stop_locations)
+      if any([stop.status_error for stop in route_fetcher.stops]):
+        self.failures += 1
+      else:
+        self.vehicles += sum([len(locations[0]) for _, locations in stop_locations])
+
+  return LoadTestBus()
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.INFO)
+  parser = argparse.ArgumentParser(description="Stand-in BusTime API, and a load driver for it.")
+  subparsers = parser.add_subparsers(dest="command")
+  serve_parser = subparsers.add_parser("serve", help="serve captured responses")
+  serve_parser.add_argument("--port", type=int, default=8000)
+  serve_parser.add_argument("--latency", type=float, default=0.0, help="seconds per request, on average")
+  serve_parser.add_argument("--jitter", type=float, default=0.0, help="latency varies by up to this much either way")
+  serve_parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests that fail: " + ', '.join(failure_kinds))
+  serve_parser.add_argument("--vehicles", type=int, default=None, help="vehicles per response (default: as captured)")
+  load_parser = subparsers.add_parser("load", help="find how many stops one process can keep up with")
+  load_parser.add_argument("--host", default="localhost:8000")
+  load_parser.add_argument("--stops", default="5,10,20,40,80,160,320", help="comma-separated stop counts to try")
+  load_parser.add_argument("--ticks", type=int, default=4)
+  load_parser.add_argument("--workers", type=int, default=4, help="fetch threads, with --per-stop (by route, there's one per route)")
+  load_parser.add_argument("--per-stop", action="store_true", help="fetch each stop's stop-monitoring response, instead of each route's vehicle-monitoring one")
+  load_parser.add_argument("--tick-seconds", type=float, default=15)
+  args = parser.parse_args()
+
+  if args.command == "serve":
+    serve(args.port, StandInData(vehicles=args.vehicles), args.latency, args.jitter, args.error_rate)
+  else:
+    results = drive(args.host, StandInData().captured_stops(), map(int, args.stops.split(',')), args.ticks, args.workers, args.tick_seconds, by_route=not args.per_stop)
+    sustained = [row for row in results if row[3] <= args.tick_seconds]
+    for stops, vehicles, mean, slowest, failures in results:
+      print("%(stops)5i stops %(vehicles)6i vehicles/tick %(mean)7.2fs/tick %(max)7.2fs slowest %(failures)5i failed" %
+        {'stops': stops, 'vehicles': vehicles, 'mean': mean, 'max': slowest, 'failures': failures})
+    if sustained:
+      print("sustains %(stops)i stops, %(vehicles)i vehicles per %(tick)is tick" % {'stops': sustained[-1][0], 'vehicles': sustained[-1][1], 'tick': args.tick_seconds})
+    else:
+      print("can't keep up with even %(stops)i stops per %(tick)is tick" % {'stops': results[0][0], 'tick': args.tick_seconds})
@@ -5,12 +5,18 @@ __email__ = 'jeremybmerrill@gmail.com'
 __license__ = 'Apache'
 __version__ = '0.1'
 
-from sqlalchemy import Column, ForeignKey, Integer, String, Text, DateTime
-from sqlalchemy import orm
+from sqlalchemy import Column, ForeignKey, Integer, String, Text, DateTime, Boolean, Index, Table
+from sqlalchemy import orm, inspect
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
 
+segment_count = 40 # segment0 through segment39
+
+# any segment longer than this disqualifies the trajectory, since something went wonky here
+MAX_SEGMENT_TIME = 300 
+MIN_SEGMENT_TIME = 20
+
 class Trajectory(Base):
   __tablename__ = 'trajectories'
   traj_id = Column(Integer, primary_key=True)
@@ -60,19 +66,87 @@ class Trajectory(Base):
   green_light_time = Column(DateTime, nullable=True)
   red_light_time = Column(DateTime, nullable=True)
   error = Column(Integer, nullable=True)
+  # computed when the trajectory's created, so the db can find similar ones without us looking at every row.
+  # (see migrate for dbs from before these existed)
+  weekday_type = Column(Integer, nullable=True) # 0 weekday, 1 weekend
+  time_bucket = Column(Integer, nullable=True) # see time_bucket()
+  is_clean = Column(Boolean, nullable=True) # see is_clean()
+  __table_args__ = (Index('ix_trajectories_route_stop_bucket', 'route_name', 'end_stop_id', 'time_bucket'), )
 
   def __init__(self, route_name, stop_id, start_time):
     self.route_name = route_name
     self.end_stop_id = stop_id
     self.start_time = start_time
+    self.set_buckets()
 
   def set_segment_intervals(self, segment_intervals):
     for index, segment_interval in enumerate(segment_intervals):
       column = "segment" + str(index)
       setattr(self, column, segment_interval)
+    self.is_clean = is_clean(self.segment_intervals())
+
+  def segment_intervals(self):
+    return [getattr(self, "segment" + str(index)) for index in xrange(segment_count)]
+
+  def set_buckets(self):
+    if self.start_time is not None:
+      self.weekday_type = 1 if is_weekend(self.start_time) else 0
+      self.time_bucket = time_bucket(self.start_time)
 
   def __repr__(self):
     return ', '.join(map(str, [self.segment0, self.segment1, self.segment2, self.segment3, self.segment4, self.segment5, self.segment6, self.segment7, self.segment8, self.segment9, self.segment10, self.segment11, self.segment12, self.segment13, self.segment14, self.segment15, self.segment16, self.segment17, self.segment18, self.segment19, self.segment20, self.segment21, self.segment22, self.segment23, self.segment24, self.segment25, self.segment26, self.segment27, self.segment28, self.segment29, self.segment30, self.segment31, self.segment32, self.segment33, self.segment34, self.segment35, self.segment36, self.segment37, self.segment38, self.segment39]))
   # @staticmethod
   # def to_time_vector(trajectory_time):
-  #   return (trajectory_time.weekday(), (trajectory_time.hour * 2) + (trajectory_time.minute / 30) )
\ No newline at end of file
+  #   return (trajectory_time.weekday(), (trajectory_time.hour * 2) + (trajectory_time.minute / 30) )
+
+# trajectories that have aged out of a TrajectoryStore's history window: nothing predicts from
+# them, but they're kept, column for column, for looking at later.
+archived_trajectories = Table('archived_trajectories', Base.metadata, *[column.copy() for column in Trajectory.__table__.columns])
+
+def archive(session, traj_ids):
+  """Move the trajectories with traj_ids from the trajectories table to archived_trajectories (committed with the session)."""
+  trajectories = Trajectory.__table__
+  column_names = [column.name for column in trajectories.columns]
+  for start in xrange(0, len(traj_ids), 500): # SQLite allows 999 variables per statement
+    chunk = traj_ids[start:start + 500]
+    session.execute(archived_trajectories.insert().from_select(column_names, trajectories.select().where(trajectories.c.traj_id.in_(chunk))))
+    session.execute(trajectories.delete().where(trajectories.c.traj_id.in_(chunk)))
+
+def is_clean(segment_intervals):
+  """False if any segment is implausibly long or short (see MAX_SEGMENT_TIME), in which case we don't predict from it."""
+  return not any([seg is not None and (seg > MAX_SEGMENT_TIME or seg < MIN_SEGMENT_TIME) for seg in segment_intervals])
+
+def time_bucket(start_time):
+  """Trajectories in the same bucket are similar enough in time to predict from: on weekdays, the
+     time_of_day (0-3); every weekend trajectory is in bucket 4."""
+  return 4 if is_weekend(start_time) else time_of_day(start_time)
+
+def is_weekend(start_time):
+  return start_time.weekday() in [5,6]
+
+def time_of_day(start_time):
+  if start_time.hour in [7,8,9]:
+    return 0
+  elif start_time.hour in [17,18,19]:
+    return 1
+  elif start_time.hour in [10,11,12,13,14,15,16]:
+    return 2
+  elif start_time.hour in  [20,21,22,23,0,1,2,3,4,5,6]:
+    return 3
+
+def migrate(engine, session):
+  """Add weekday_type, time_bucket and is_clean (and their index) to a trajectories table from before they existed, and fill them in."""
+  inspector = inspect(engine)
+  columns = [column['name'] for column in inspector.get_columns(Trajectory.__tablename__)]
+  for column in [Trajectory.weekday_type, Trajectory.time_bucket, Trajectory.is_clean]:
+    if column.name not in columns:
+      engine.execute("ALTER TABLE %(table)s ADD COLUMN %(column)s %(type)s" %
+        {'table': Trajectory.__tablename__, 'column': column.name, 'type': column.type.compile(engine.dialect)})
+  indexes = [index['name'] for index in inspector.get_indexes(Trajectory.__tablename__)]
+  for index in Trajectory.__table__.indexes:
+    if index.name not in indexes:
+      index.create(bind=engine)
+  for trajectory in session.query(Trajectory).filter(Trajectory.time_bucket == None):
+    trajectory.set_buckets()
+    trajectory.is_clean = is_clean(trajectory.segment_intervals())
+  session.commit()
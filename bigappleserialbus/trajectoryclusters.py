@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+__author__ = 'Jeremy B. Merrill'
+__email__ = 'jeremybmerrill@gmail.com'
+__license__ = 'Apache'
+__version__ = '0.1'
+
+import numpy as np
+from sqlalchemy import Column, Integer, String, Text
+from trajectory import Base
+from minibatchkmeans import MiniBatchKMeans
+
+import logging #magically the same as the one in bigappleserialbus.py
+
+trajectories_per_cluster = 10 # about as many as k nearest neighbors finds
+memory = 100 # trajectories; see MiniBatchKMeans
+no_bucket = -1 # stands in for a None time bucket in the db
+
+class ClusterModel(Base):
+  """A TrajectoryClusters' centroids, saved so the next run can pick up where this one left off."""
+  __tablename__ = 'cluster_models'
+  route_name = Column(String(250), primary_key=True)
+  end_stop_id = Column(String(10), primary_key=True)
+  time_bucket = Column(Integer, primary_key=True)
+  prefix_length = Column(Integer, primary_key=True)
+  centroids_serialized = Column(Text(), nullable=False) # rows separated by ;
+  counts_serialized = Column(Text(), nullable=False)
+  trained_through_traj_id = Column(Integer, nullable=False)
+
+  def __init__(self, key):
+    self.route_name, self.end_stop_id, bucket, self.prefix_length = key
+    self.time_bucket = no_bucket if bucket is None else bucket
+
+  def model(self):
+    centroids = [map(float, row.split(",")) for row in self.centroids_serialized.split(";")]
+    counts = map(float, self.counts_serialized.split(","))
+    return MiniBatchKMeans(len(centroids), memory, centroids=centroids, counts=counts)
+
+  def set_model(self, model, trained_through_traj_id):
+    self.centroids_serialized = ';'.join([','.join(map(repr, row)) for row in model.centroids.tolist()])
+    self.counts_serialized = ','.join(map(repr, model.counts.tolist()))
+    self.trained_through_traj_id = trained_through_traj_id
+
+class TrajectoryClusters:
+  """Mini-batch k-means clusters of one store's trajectories in one time bucket, by their first
+     prefix_length segments; the trajectories in a bus's cluster are the similar ones.
+
+     Fitted once (or loaded from the db), then, whenever the bucket gets new trajectories, the
+     centroids take a mini-batch step toward them and are saved again. Finding a bus's cluster
+     takes one distance per centroid.
+  """
+  def __init__(self, key, max_clusters, saved=None):
+    self.key = key
+    self.max_clusters = max_clusters
+    self.saved = saved # the ClusterModel row, once there is one
+    self.model = None
+    self.trained_through = 0 # the store's `added` when the model last learned
+    self.version = None # of the store's bucket, when rows and labels were last computed
+    self.rows = np.empty(0, dtype=int)
+    self.labels = np.empty(0, dtype=int)
+
+  def cluster_count(self, trajectory_count):
+    return max(1, min(self.max_clusters, trajectory_count / trajectories_per_cluster))
+
+  def refresh(self, store, candidates, features, version, session=None):
+    """Learn from whatever's been added to candidates (rows of store) since last time, and re-cluster them.
+
+       features(rows) gives the rows' (preprocessed) prefixes. Given a session, a model that was just
+       fit, or that learned from new trajectories, is saved to it.
+    """
+    if version == self.version:
+      return
+    new_rows = candidates[store.sequences[candidates] >= self.trained_through]
+    if self.model is None or len(self.model.centroids) * 2 <= self.cluster_count(len(candidates)):
+      # first time, or there are enough trajectories now for a lot more clusters: start over.
+      self.model = MiniBatchKMeans(self.cluster_count(len(candidates)), memory).fit(features(candidates))
+      learned = True
+    elif len(new_rows):
+      self.model.partial_fit(features(new_rows))
+      learned = True
+    else:
+      learned = False
+    self.trained_through = store.added
+    self.version = version
+    self.rows = candidates
+    self.labels = self.model.predict(features(candidates))
+    if learned and session is not None and len(candidates):
+      self.save(session, int(store.traj_ids[candidates].max()))
+
+  def save(self, session, trained_through_traj_id):
+    if self.saved is None:
+      self.saved = ClusterModel(self.key)
+      session.add(self.saved)
+    self.saved.set_model(self.model, trained_through_traj_id)
+
+  def similar(self, query):
+    """The rows in query's cluster, or, if no trajectory's in that one, the nearest cluster that has some."""
+    order = self.model.distances(query)[0].argsort()
+    populated = np.bincount(self.labels, minlength=len(order)) > 0
+    cluster = order[populated[order]][0]
+    return self.rows[self.labels == cluster]
+
+loaded = {} # (route_name, end_stop_id, time bucket, prefix length) -> TrajectoryClusters
+
+def clusters_for(store, bucket, prefix_length, candidates, features, session=None, max_clusters=144):
+  """The TrajectoryClusters for store's trajectories in bucket, brought up to date with candidates (see TrajectoryClusters.refresh).
+
+     The first time, it's loaded from the db, if it's been saved there; it has already learned from
+     every trajectory up to the one it was saved after.
+  """
+  key = (store.route_name, store.end_stop_id, bucket, prefix_length)
+  clusters = loaded.get(key)
+  if clusters is None:
+    saved = session.query(ClusterModel).get((key[0], key[1], no_bucket if bucket is None else bucket, prefix_length)) if session is not None else None
+    clusters = loaded[key] = TrajectoryClusters(key, max_clusters, saved)
+    if saved is not None:
+      clusters.model = saved.model()
+      unseen = np.flatnonzero(store.traj_ids > saved.trained_through_traj_id)
+      clusters.trained_through = store.sequences[unseen[0]] if len(unseen) else store.added
+      logging.debug("loaded %(count)i clusters for %(key)s" % {'count': len(clusters.model.centroids), 'key': key})
+  clusters.refresh(store, candidates, features, store.version_of(bucket), session)
+  return clusters
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+__author__ = 'Jeremy B. Merrill'
+__email__ = 'jeremybmerrill@gmail.com'
+__license__ = 'Apache'
+__version__ = '0.1'
+
+import random
+import numpy as np
+from sqlalchemy import Column, Integer, String, Text, Float
+from trajectory import Base
+import kmodes
+
+import logging #magically the same as the one in bigappleserialbus.py
+
+trajectories_per_cluster = 10 # like trajectoryclusters.py
+restarts = 4 # k-prototypes runs, from different seeds, to keep the cheapest of
+refit_after = 0.5 # start over once this many new trajectories, per one already clustered, have come in
+time_weight = 0.5 # what a different weekday or time bucket costs, in units of the prefixes' total variance
+
+class PrototypeModel(Base):
+  """A TrajectoryPrototypes' prototypes, saved so the next run doesn't have to cluster from scratch."""
+  __tablename__ = 'prototype_models'
+  route_name = Column(String(250), primary_key=True)
+  end_stop_id = Column(String(10), primary_key=True)
+  prefix_length = Column(Integer, primary_key=True)
+  numeric_serialized = Column(Text(), nullable=False) # rows separated by ;
+  categorical_serialized = Column(Text(), nullable=False)
+  gamma = Column(Float, nullable=False)
+  trained_count = Column(Integer, nullable=False)
+  trained_through_traj_id = Column(Integer, nullable=False)
+
+  def __init__(self, key):
+    self.route_name, self.end_stop_id, self.prefix_length = key
+
+  def prototypes(self):
+    numeric = [map(float, row.split(",")) for row in self.numeric_serialized.split(";")]
+    categorical = [map(int, row.split(",")) for row in self.categorical_serialized.split(";")]
+    return (np.array(numeric), np.array(categorical), self.gamma)
+
+  def set_prototypes(self, prototypes, trained_count, trained_through_traj_id):
+    numeric, categorical, self.gamma = prototypes
+    self.numeric_serialized = ';'.join([','.join(map(repr, row)) for row in numeric.tolist()])
+    self.categorical_serialized = ';'.join([','.join(map(str, row)) for row in categorical.tolist()])
+    self.trained_count = trained_count
+    self.trained_through_traj_id = trained_through_traj_id
+
+class TrajectoryPrototypes:
+  """k-prototypes clusters (see kmodes.KPrototypes) of one store's trajectories, by their first
+     prefix_length segments and, together with those, the weekday and time bucket they started in;
+     the trajectories in a bus's cluster are the similar ones.
+
+     Unlike TrajectoryClusters, there's one model for all the time buckets, so trajectories from
+     the rest of the week can still be similar, if they're similar enough. k-prototypes can't learn
+     a little at a time, so it starts over once enough new trajectories have come in (see
+     refit_after); in between, new trajectories just go in their nearest cluster. Finding a bus's
+     cluster takes one dissimilarity per prototype.
+  """
+  def __init__(self, key, max_clusters, saved=None):
+    self.key = key
+    self.max_clusters = max_clusters
+    self.saved = saved # the PrototypeModel row, once there is one
+    self.prototypes = None # (numeric [k x prefix features], categorical [k x 2], gamma)
+    self.trained_count = 0 # how many trajectories they were clustered from
+    self.trained_through = 0 # the store's `added` when they were
+    self.version = None # of the store, when rows and labels were last computed
+    self.rows = np.empty(0, dtype=int)
+    self.labels = np.empty(0, dtype=int)
+
+  def cluster_count(self, trajectory_count):
+    return max(1, min(self.max_clusters, trajectory_count / trajectories_per_cluster))
+
+  def refresh(self, store, features, session=None):
+    """Re-cluster the store's trajectories that are long enough, if it's changed, starting over if enough are new.
+
+       features(rows) gives the rows' (numeric, categorical) features. Given a session, new prototypes are saved to it.
+    """
+    if store.version == self.version:
+      return
+    rows = np.flatnonzero(store.lengths >= self.key[2])
+    numeric, categorical = features(rows)
+    new_count = int((store.sequences[rows] >= self.trained_through).sum())
+    if self.prototypes is None or new_count >= refit_after * self.trained_count:
+      self.prototypes = fit_prototypes(numeric, categorical, self.cluster_count(len(rows)))
+      self.trained_count = len(rows)
+      self.trained_through = store.added
+      if session is not None and len(rows):
+        self.save(session, int(store.traj_ids[rows].max()))
+    self.version = store.version
+    self.rows = rows
+    self.labels = dissimilarities(self.prototypes, numeric, categorical).argmin(axis=1)
+
+  def save(self, session, trained_through_traj_id):
+    if self.saved is None:
+      self.saved = PrototypeModel(self.key)
+      session.add(self.saved)
+    self.saved.set_prototypes(self.prototypes, self.trained_count, trained_through_traj_id)
+
+  def similar(self, numeric, categorical):
+    """The rows in the query's cluster, or, if no trajectory's in that one, the nearest cluster that has some."""
+    if not len(self.rows):
+      return self.rows
+    order = dissimilarities(self.prototypes, numeric, categorical)[0].argsort()
+    populated = np.bincount(self.labels, minlength=len(order)) > 0
+    cluster = order[populated[order]][0]
+    return self.rows[self.labels == cluster]
+
+def fit_prototypes(numeric, categorical, k):
+  """(numeric prototypes, categorical prototypes, gamma) for the cheapest of `restarts` seeded KPrototypes runs.
+
+     Seeded, so the same trajectories always make the same clusters; the random modules' state is put back after.
+  """
+  gamma = time_weight * float(numeric.var(axis=0).sum()) if len(numeric) else 0.
+  # KPrototypes needs more points than clusters, and a point that isn't a prototype to start each cluster
+  # from (and to fill an empty one), so it needs more distinct points, and categorical features, than that
+  distinct = len(set(map(tuple, np.hstack([numeric, categorical]).tolist())))
+  distinct_categorical = len(set(map(tuple, categorical.tolist())))
+  k = min(k, distinct - 1, distinct_categorical - 1)
+  if k < 2:
+    return (numeric.mean(axis=0)[np.newaxis] if len(numeric) else np.zeros((1, numeric.shape[1])),
+            categorical[:1] if len(categorical) else np.zeros((1, categorical.shape[1]), dtype=int), gamma)
+  random_state, np_random_state = random.getstate(), np.random.get_state()
+  best = None
+  try:
+    for seed in xrange(restarts):
+      random.seed(seed)
+      np.random.seed(seed)
+      model = kmodes.KPrototypes(k)
+      model._perform_clustering([numeric, categorical], gamma=gamma, verbose=0)
+      if best is None or model.cost < best.cost:
+        best = model
+  finally:
+    random.setstate(random_state)
+    np.random.set_state(np_random_state)
+  return (best.centroids[0], best.centroids[1].astype(int), gamma)
+
+def dissimilarities(prototypes, numeric, categorical):
+  """KPrototypes' dissimilarity of each point to each prototype [no. points x k]: squared distance
+     between the numeric features plus gamma for each categorical one that's different (None if they're unknown)."""
+  numeric_prototypes, categorical_prototypes, gamma = prototypes
+  numeric = np.atleast_2d(numeric)
+  dissimilarities = ((numeric[:, np.newaxis, :] - numeric_prototypes[np.newaxis, :, :]) ** 2).sum(axis=2)
+  if categorical is not None:
+    categorical = np.atleast_2d(categorical)
+    dissimilarities += gamma * (categorical[:, np.newaxis, :] != categorical_prototypes[np.newaxis, :, :]).sum(axis=2)
+  return dissimilarities
+
+loaded = {} # (route_name, end_stop_id, prefix length) -> TrajectoryPrototypes
+
+def prototypes_for(store, prefix_length, features, session=None, max_clusters=144):
+  """The TrajectoryPrototypes for store's trajectories, brought up to date with it (see TrajectoryPrototypes.refresh).
+
+     The first time, they're loaded from the db, if they've been saved there; they were clustered from
+     trajectories up to the one they were saved after, so only later ones count toward starting over.
+  """
+  key = (store.route_name, store.end_stop_id, prefix_length)
+  prototypes = loaded.get(key)
+  if prototypes is None:
+    saved = session.query(PrototypeModel).get(key) if session is not None else None
+    prototypes = loaded[key] = TrajectoryPrototypes(key, max_clusters, saved)
+    if saved is not None:
+      prototypes.prototypes = saved.prototypes()
+      prototypes.trained_count = saved.trained_count
+      unseen = np.flatnonzero(store.traj_ids > saved.trained_through_traj_id)
+      prototypes.trained_through = store.sequences[unseen[0]] if len(unseen) else store.added
+      logging.debug("loaded %(count)i prototypes for %(key)s" % {'count': len(prototypes.prototypes[0]), 'key': key})
+  prototypes.refresh(store, features, session)
+  return prototypes
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+
+__author__ = 'Jeremy B. Merrill'
+__email__ = 'jeremybmerrill@gmail.com'
+__license__ = 'Apache'
+__version__ = '0.1'
+
+import numpy as np
+from collections import OrderedDict
+from sqlalchemy import orm
+from trajectory import Trajectory, segment_count, time_bucket, archive
+
+import logging #magically the same as the one in bigappleserialbus.py
+
+no_segment = -1 # stands in for a None segment in TrajectoryStore.segments
+no_traj_id = -1 # for trajectories that were never saved to the db
+initial_capacity = 256 # rows
+max_fitted_indexes = 64 # about one per bus being predicted, with room to spare
+min_segment_time_trajectories = 5 # fewer than this in a time bucket, and its SegmentTimes don't estimate anything
+
+# how much history each route, stop and time bucket predicts from; None for all of it.
+# (config.yaml can set these per stop, as history_count and history_days.)
+history_max_count = None # trajectories per time bucket
+history_max_days = None # before the newest trajectory
+
+class TrajectoryStore:
+  """The clean trajectories for one route and end stop, kept in memory as NumPy arrays.
+
+     Loaded from the db once, then appended to as buses finish (see append), so
+     Bus.find_similar_trajectories never has to query for them. Row i of each array is one
+     trajectory, in the order they were saved.
+
+     Each time bucket keeps at most max_count trajectories, none more than max_days older than the
+     newest; the rest are evicted (see evict), so predictions don't get slower, or stuck in old
+     schedules, the longer we run.
+  """
+  def __init__(self, route_name, end_stop_id, max_count=None, max_days=None):
+    self.route_name = route_name
+    self.end_stop_id = end_stop_id
+    self.max_count = max_count
+    self.max_days = max_days
+    self.count = 0
+    self.added = 0 # how many trajectories have ever been added, evicted or not
+    self.version = 0 # goes up whenever trajectories are added or evicted
+    self.bucket_versions = {} # time bucket -> goes up whenever that bucket's rows change
+    self.evictions = 0 # goes up whenever rows move (see keep), so rows from before then are of other trajectories
+    self._segment_times = {} # time bucket -> SegmentTimes, as of some version of it
+    self._traj_ids = np.empty(initial_capacity, dtype=np.int64)
+    self._sequences = np.empty(initial_capacity, dtype=np.int64)
+    self._segments = np.empty((initial_capacity, segment_count), dtype=np.int16)
+    self._lengths = np.empty(initial_capacity, dtype=np.int8)
+    self._start_times = np.empty(initial_capacity, dtype='datetime64[s]')
+    self._time_buckets = np.empty(initial_capacity, dtype=np.int8)
+    self._cumulative = np.empty((initial_capacity, segment_count + 1), dtype=np.int32)
+
+  # the arrays have room to grow; these are just the rows that are filled in.
+  @property
+  def traj_ids(self):
+    return self._traj_ids[:self.count]
+
+  @property
+  def sequences(self):
+    """The order trajectories were added in: the ones with sequences >= an earlier self.added were added since."""
+    return self._sequences[:self.count]
+
+  @property
+  def segments(self):
+    """Segment intervals in seconds, no_segment after the end of the trajectory."""
+    return self._segments[:self.count]
+
+  @property
+  def lengths(self):
+    """How many segments each trajectory has before the first None."""
+    return self._lengths[:self.count]
+
+  @property
+  def start_times(self):
+    return self._start_times[:self.count]
+
+  @property
+  def weekdays(self):
+    """Each trajectory's start_time.weekday(), i.e. 0 for Monday through 6 for Sunday."""
+    return (self.start_times.astype('datetime64[D]').astype(np.int64) + 3) % 7 # 1970-01-01 was a Thursday
+
+  @property
+  def time_buckets(self):
+    return self._time_buckets[:self.count]
+
+  @property
+  def cumulative(self):
+    """cumulative[i, j] is the sum of trajectory i's first j segments, i.e. how long it took from the first stop to the j-th."""
+    return self._cumulative[:self.count]
+
+  def remaining_times(self, rows, from_segment, to_segment):
+    """For each of rows, how long that trajectory took from stop number from_segment to stop number to_segment."""
+    return self._cumulative[rows, to_segment] - self._cumulative[rows, from_segment]
+
+  def load(self, session):
+    # the db leaves out the dirty ones (see Trajectory.is_clean)
+    segment_columns = [getattr(Trajectory, "segment" + str(index)) for index in xrange(segment_count)]
+    rows = session.query(Trajectory.traj_id, Trajectory.start_time, Trajectory.time_bucket, *segment_columns).\
+              filter(Trajectory.route_name == self.route_name).filter(Trajectory.end_stop_id == self.end_stop_id).\
+              filter(Trajectory.is_clean == True).order_by(Trajectory.traj_id)
+    for row in rows:
+      self.add(row[1], row[2], row[3:], row[0])
+    evicted = self.evict(session)
+    logging.debug("loaded %(count)i trajectories for %(route)s/%(stop)s, archived %(evicted)i" %
+      {'count': self.count, 'route': self.route_name, 'stop': self.end_stop_id, 'evicted': evicted})
+    return self
+
+  def append(self, trajectory):
+    """Add a just-saved Trajectory (if it's clean), evicting whatever that pushes out of its bucket's window."""
+    if not trajectory.is_clean:
+      return
+    session = orm.object_session(trajectory) # None if it isn't being saved, e.g. in most replays
+    if session is not None and trajectory.traj_id is None and self.has_window():
+      session.flush() # so it has a traj_id to archive it by, once it's evicted
+    self.add(trajectory.start_time, trajectory.time_bucket, trajectory.segment_intervals(), trajectory.traj_id)
+    self.evict(session, [trajectory.time_bucket])
+
+  def add(self, start_time, bucket, segment_intervals, traj_id=None):
+    if self.count == len(self._segments):
+      self.grow()
+    segment_intervals = list(segment_intervals)
+    self._traj_ids[self.count] = no_traj_id if traj_id is None else traj_id
+    self._sequences[self.count] = self.added
+    self._segments[self.count] = [no_segment if seg is None else seg for seg in segment_intervals]
+    self._lengths[self.count] = segment_intervals.index(None) if None in segment_intervals else segment_count
+    self._start_times[self.count] = start_time
+    self._time_buckets[self.count] = bucket
+    self._cumulative[self.count, 0] = 0
+    np.cumsum(np.maximum(self._segments[self.count], 0), out=self._cumulative[self.count, 1:])
+    self.count += 1
+    self.added += 1
+    self.version += 1
+    self.bucket_versions[bucket] = self.bucket_versions.get(bucket, 0) + 1
+
+  def version_of(self, bucket):
+    """Changes whenever a trajectory is added to bucket (or to any bucket, if it's None)."""
+    return self.version if bucket is None else self.bucket_versions.get(bucket, 0)
+
+  def segment_times(self, bucket):
+    """The SegmentTimes of bucket's trajectories (or every trajectory's, if it's None), recomputed only once the bucket's changed."""
+    version = self.version_of(bucket)
+    times = self._segment_times.get(bucket)
+    if times is None or times.version != version:
+      rows = np.arange(self.count) if bucket is None else np.flatnonzero(self.time_buckets == bucket)
+      times = self._segment_times[bucket] = SegmentTimes(self.segments[rows], version)
+    return times
+
+  def has_window(self):
+    return self.max_count is not None or self.max_days is not None
+
+  def evict(self, session=None, buckets=None):
+    """Drop the trajectories outside the window from each of buckets (every bucket, if None) and, given a
+       session, move them to the archive table (see trajectory.archive). Returns how many were dropped."""
+    if not self.has_window() or self.count == 0:
+      return 0
+    evicted = np.zeros(self.count, dtype=bool)
+    if self.max_days is not None:
+      evicted |= self.start_times < self.start_times.max() - np.timedelta64(self.max_days, 'D')
+    if self.max_count is not None:
+      for bucket in (self.bucket_versions.keys() if buckets is None else buckets):
+        rows = np.flatnonzero((self.time_buckets == bucket) & ~evicted)
+        evicted[rows[:max(len(rows) - self.max_count, 0)]] = True # oldest first
+    if not evicted.any():
+      return 0
+    if session is not None:
+      archive(session, [int(traj_id) for traj_id in self.traj_ids[evicted] if traj_id != no_traj_id])
+    self.keep(~evicted)
+    return int(evicted.sum())
+
+  def keep(self, kept):
+    """Drop every row but the kept ones (a boolean mask). Rows move, so every bucket's version changes."""
+    kept_count = int(kept.sum())
+    for name in array_names:
+      array = getattr(self, name)
+      array[:kept_count] = array[:self.count][kept]
+    self.count = kept_count
+    self.version += 1
+    self.evictions += 1
+    for bucket in self.bucket_versions:
+      self.bucket_versions[bucket] += 1
+
+  def grow(self):
+    for name in array_names:
+      array = getattr(self, name)
+      grown = np.empty((len(array) * 2,) + array.shape[1:], dtype=array.dtype)
+      grown[:len(array)] = array
+      setattr(self, name, grown)
+
+  def candidates(self, start_time):
+    """Indexes of the trajectories in start_time's time_bucket (every trajectory, if start_time is None)."""
+    if start_time is None:
+      return np.arange(self.count)
+    return np.flatnonzero(self.time_buckets == time_bucket(start_time))
+
+class SegmentTimes:
+  """How long each segment of the route took, over some trajectories: the median and 80th percentile
+     of each one's times. Adding up a bus's remaining segments' medians estimates its arrival with no
+     search at all; added up ahead of time, so that's one subtraction.
+  """
+  def __init__(self, segments, version):
+    self.version = version
+    self.count = len(segments)
+    self.medians = np.empty(segment_count)
+    self.p80s = np.empty(segment_count)
+    # only the segments every trajectory has; the rest stay nan
+    defined = (segments != no_segment).all(axis=0) & (self.count > 0)
+    self.medians[~defined] = self.p80s[~defined] = np.nan
+    if defined.any():
+      self.medians[defined], self.p80s[defined] = np.percentile(segments[:, defined], [50, 80], axis=0)
+    self.cumulative_medians = np.concatenate([[0], np.cumsum(self.medians)])
+    self.cumulative_p80s = np.concatenate([[0], np.cumsum(self.p80s)])
+
+  def between(self, from_segment, to_segment):
+    """(median, 80th percentile) time from stop number from_segment to stop number to_segment, or None if
+       there aren't enough trajectories, or some of them don't go that far."""
+    if self.count < min_segment_time_trajectories:
+      return None
+    median = self.cumulative_medians[to_segment] - self.cumulative_medians[from_segment]
+    p80 = self.cumulative_p80s[to_segment] - self.cumulative_p80s[from_segment]
+    if np.isnan(median) or np.isnan(p80):
+      return None
+    return (median, p80)
+
+array_names = ['_traj_ids', '_sequences', '_segments', '_lengths', '_start_times', '_time_buckets', '_cumulative']
+
+class FittedIndexCache:
+  """Nearest-neighbor indexes fitted on stores' trajectories, so buses (and ticks) can share them.
+
+     Keyed by (route_name, end_stop_id, time bucket, prefix length); an index is refitted only once
+     its bucket has gained trajectories since it was fitted. Past max_entries, the least recently
+     used is dropped.
+  """
+  def __init__(self, max_entries=max_fitted_indexes):
+    self.max_entries = max_entries
+    self.entries = OrderedDict() # key -> (version, index), least recently used first
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key, version, fit):
+    """The index for key as of version, calling fit() to make it if it's not cached (or stale)."""
+    entry = self.entries.pop(key, None)
+    if entry is not None and entry[0] == version:
+      self.hits += 1
+      index = entry[1]
+    else:
+      self.misses += 1
+      index = fit()
+    self.entries[key] = (version, index)
+    while len(self.entries) > self.max_entries:
+      self.entries.popitem(last=False)
+    return index
+
+fitted_indexes = FittedIndexCache()
+
+stores = {} # (route_name, end_stop_id) -> TrajectoryStore
+
+def store_for(route_name, end_stop_id, session, max_count=None, max_days=None):
+  """The TrajectoryStore for a route and end stop, loading it from the db the first time it's asked for.
+
+     max_count and max_days default to history_max_count and history_max_days, and only count the first time.
+  """
+  key = (route_name, end_stop_id)
+  if key not in stores:
+    stores[key] = TrajectoryStore(route_name, end_stop_id,
+                                  history_max_count if max_count is None else max_count,
+                                  history_max_days if max_days is None else max_days).load(session)
+  return stores[key]